@@ -0,0 +1,119 @@
+#
+# accumulator_benchmark.py
+#
+
+
+# ====================================================================================================
+
+
+# throughput of iteration raster accumulation for each iter_dtype option in runscript_b005.py
+# times the per iteration steps done by workers (bincount of location dollars into cells, cast to
+# accumulator dtype), the message sent to master (pickled raster) and the statistics update on master
+# using synthetic locations
+
+# python /path/to/accumulator_benchmark.py [cells] [locations] [iterations]
+
+
+from __future__ import print_function
+
+import sys
+import time
+import pickle
+
+import numpy as np
+
+
+arg = sys.argv
+
+try:
+	n_cells = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+	n_locations = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+	iterations = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+except:
+	sys.exit("invalid inputs")
+
+
+rng = np.random.Generator(np.random.Philox(key=0))
+
+# dollars and cells of every location for each iteration
+loc_dollars = rng.lognormal(mean=8, sigma=3, size=(iterations, n_locations))
+loc_cells = rng.integers(0, n_cells, size=(iterations, n_locations))
+
+
+# --------------------------------------------------
+
+
+def run(dtype):
+	stats_sum = np.zeros((2, n_cells), dtype=np.float64)
+	stats_sumsq = np.zeros((2, n_cells), dtype=np.float64)
+
+	t_worker = 0
+	t_message = 0
+	t_master = 0
+	message_bytes = 0
+
+	for i in range(iterations):
+
+		t0 = time.time()
+
+		dollars = loc_dollars[i]
+		if dtype == "int64":
+			dollars = np.trunc(dollars)
+
+		valid = dollars > 0
+
+		npa_aid = np.bincount(loc_cells[i][valid], weights=dollars[valid], minlength=n_cells)
+		npa_count = np.bincount(loc_cells[i][valid], minlength=n_cells)
+
+		result = np.array([npa_aid, npa_count]).astype(dtype)
+
+		t1 = time.time()
+
+		message = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+		result = pickle.loads(message)
+		message_bytes = len(message)
+
+		t2 = time.time()
+
+		result = np.asarray(result, dtype=np.float64)
+		stats_sum += result
+		stats_sumsq += result**2
+
+		t3 = time.time()
+
+		t_worker += t1 - t0
+		t_message += t2 - t1
+		t_master += t3 - t2
+
+	return {
+		"total": t_worker + t_message + t_master,
+		"worker": t_worker,
+		"message": t_message,
+		"master": t_master,
+		"bytes": message_bytes,
+		"aid": np.sum(stats_sum[0]) / iterations
+	}
+
+
+# --------------------------------------------------
+
+
+print("cells: %d, locations: %d, iterations: %d" % (n_cells, n_locations, iterations))
+print("")
+print("%-8s %10s %10s %10s %10s %12s %14s" % ("dtype", "iter/s", "worker ms", "message ms", "master ms", "message MB", "aid kept"))
+
+results = {}
+for dtype in ["float64", "float32", "int64"]:
+	results[dtype] = run(dtype)
+
+for dtype in ["float64", "float32", "int64"]:
+	r = results[dtype]
+	print("%-8s %10.1f %10.2f %10.2f %10.2f %12.2f %13.6f%%" % (
+		dtype,
+		iterations / r["total"],
+		1000 * r["worker"] / iterations,
+		1000 * r["message"] / iterations,
+		1000 * r["master"] / iterations,
+		r["bytes"] / 1024.0**2,
+		100 * r["aid"] / results["float64"]["aid"]))
@@ -0,0 +1,240 @@
+# merge sufficient statistics of independent runs into a single result
+#
+# runs must be for the same country, pixel_size, data_version and filters
+# (checked using the json record of each run)
+#
+# writes combined mean, std and var aid and count rasters along with
+# statistics and a json record for the merged run, which uses a new Rid
+# and can be extended like any other run
+#
+# usage:
+#   python runmerge.py mcr_1234567890_12345 mcr_1234567999_54321 [...]
+
+# ====================================================================================================
+
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import json
+
+import numpy as np
+
+
+dir_base = os.path.dirname(os.path.abspath(__file__))
+
+arg = sys.argv
+
+merge_rids = sys.argv[1:]
+
+if len(merge_rids) < 2:
+    sys.exit("runmerge.py - at least two run ids are required")
+
+
+# fields which must match for runs to be merged
+# iter_dtype changes iteration values (int64 drops shares under a dollar)
+# iter_sampling changes the random draws (point and alias runs are different streams)
+# surf_hash covers all inputs of the mean surface errors are measured against
+merge_fields = ["country", "abbr", "pixel_size", "data_version", "filters_hash",
+                "rows", "cols", "adm0_minx", "adm0_miny", "nodata",
+                "iter_dtype", "iter_sampling", "surf_hash"]
+
+# fields of first run's json record which only describe how that run went
+# (timings, task counters, resume state), not included in merged record
+run_fields = ["size", "T_init", "T_surf", "T_iter", "T_overlap", "T_total", "run_mean_surf",
+              "iter_resumed", "iter_extended_from", "iter_extend", "task_failures", "task_reassigned",
+              "task_quarantined", "task_lost", "task_speculated", "task_speculation_wins",
+              "surf_task_seconds", "iter_task_seconds"]
+
+# statistics fields saved by runscript
+stats_fields = ["aid_sum", "aid_sumsq", "count_sum", "count_sumsq"]
+
+
+# --------------------------------------------------
+# load runs
+
+
+def json_path(rid):
+    return dir_base+'/json/mongo/ready/'+str(rid)+'.json'
+
+
+runs = []
+
+for rid in merge_rids:
+
+    if not os.path.isfile(json_path(rid)):
+        sys.exit("runmerge.py - no json record for run: "+str(rid))
+
+    with open(json_path(rid)) as f:
+        run_json = json.load(f)
+
+    stats_path = run_json["dir_working"]+"/stats.npz"
+
+    if not os.path.isfile(stats_path):
+        sys.exit("runmerge.py - no statistics for run: "+str(rid))
+
+    for field in merge_fields:
+        if len(runs) > 0 and run_json.get(field) != runs[0]["json"].get(field):
+            sys.exit("runmerge.py - "+field+" of run "+str(rid)+" does not match run "+str(runs[0]["json"]["Rid"]))
+
+    with np.load(stats_path) as f:
+        meta = json.loads(str(f["meta"]))
+        run_stats = {"n": meta["n"], "seed": meta.get("seed")}
+        for field in stats_fields:
+            run_stats[field] = f[field]
+
+    # runs with the same seed have identical iterations
+    for run in runs:
+        if run_stats["seed"] is not None and run_stats["seed"] == run["stats"]["seed"]:
+            sys.exit("runmerge.py - run "+str(rid)+" has the same seed as run "+str(run["json"]["Rid"]))
+
+    runs.append({"json": run_json, "stats": run_stats})
+
+
+# --------------------------------------------------
+# combine statistics
+
+
+merge_json = runs[0]["json"]
+
+stats = {"n": 0}
+for field in stats_fields:
+    stats[field] = np.zeros(runs[0]["stats"][field].shape, dtype=np.float64)
+
+for run in runs:
+    stats["n"] += run["stats"]["n"]
+    for field in stats_fields:
+        stats[field] += run["stats"][field]
+
+
+def statsResult(stats, prefix):
+    tmp_mean = stats[prefix+"_sum"] / stats["n"]
+    tmp_var = np.maximum(stats[prefix+"_sumsq"] / stats["n"] - tmp_mean**2, 0)
+    return tmp_mean, np.sqrt(tmp_var), tmp_var
+
+
+(mean_aid, std_aid, var_aid) = statsResult(stats, "aid")
+(mean_count, std_count, var_count) = statsResult(stats, "count")
+
+
+# --------------------------------------------------
+# outputs
+
+
+Ts = int(time.time())
+random_id = '{0:05d}'.format(int(random.random() * 10**5))
+Rid = "mcr_" + str(Ts) +"_"+ random_id
+
+# merged run goes next to the first run so it can be extended
+dir_working = os.path.dirname(merge_json["dir_working"].rstrip("/"))+"/"+Rid
+os.makedirs(dir_working)
+
+
+asc = ""
+asc += "NCOLS " + str(merge_json["cols"]) + "\n"
+asc += "NROWS " + str(merge_json["rows"]) + "\n"
+asc += "XLLCENTER " + str(merge_json["adm0_minx"]) + "\n"
+asc += "YLLCENTER " + str(merge_json["adm0_miny"]) + "\n"
+asc += "CELLSIZE " + str(merge_json["pixel_size"]) + "\n"
+asc += "NODATA_VALUE " + str(merge_json["nodata"]) + "\n"
+
+
+def write_asc(name, data):
+    fout = open(dir_working+"/"+name+".asc", "w")
+    fout.write(asc + ' '.join(np.char.mod('%f', data)))
+    fout.close()
+
+
+write_asc("mean_aid", mean_aid)
+write_asc("std_aid", std_aid)
+write_asc("var_aid", var_aid)
+write_asc("mean_count", mean_count)
+write_asc("std_count", std_count)
+write_asc("var_count", var_count)
+
+
+# error against mean surface of first run (identical for all merged runs)
+sum_aid = np.sum(mean_aid)
+
+mean_surf_path = merge_json["dir_working"]+"/mean_surf.asc"
+
+if os.path.isfile(mean_surf_path):
+    sum_mean_surf = np.loadtxt(mean_surf_path, skiprows=6).flatten()
+    error_surf = np.absolute(np.subtract(sum_mean_surf, mean_aid))
+
+    write_asc("mean_surf", sum_mean_surf)
+    write_asc("error_surf", error_surf)
+
+    error_log_mean = np.mean(error_surf)
+    error_log_sum = np.sum(error_surf)
+    error_log_percent = error_log_sum / sum_aid
+
+else:
+    error_log_mean = None
+    error_log_sum = None
+    error_log_percent = None
+
+
+# statistics in same format as runscript so merged run can be extended
+# extending uses a new seed since merged iterations come from several seeds
+run_seed = random.SystemRandom().randint(0, 2**63 - 1)
+
+meta = {
+    "Rid": Rid,
+    "n": stats["n"],
+    "seed": run_seed,
+    "checks": [],
+    "saved": Ts,
+    "merged": merge_rids
+}
+
+with open(dir_working+"/stats.npz.tmp", 'wb') as f:
+    np.savez(f, meta=np.array(json.dumps(meta)),
+             aid_sum=stats["aid_sum"], aid_sumsq=stats["aid_sumsq"],
+             count_sum=stats["count_sum"], count_sumsq=stats["count_sumsq"])
+
+os.rename(dir_working+"/stats.npz.tmp", dir_working+"/stats.npz")
+
+
+results_str = "Monte Carlo Rasterization Merged Output File\t "
+results_str += "\nstart time\t" + str(Ts)
+results_str += "\ncountry\t" + str(merge_json["country"])
+results_str += "\nabbr\t" + str(merge_json["abbr"])
+results_str += "\npixel_size\t" + str(merge_json["pixel_size"])
+results_str += "\nmerged runs\t" + ", ".join(merge_rids)
+results_str += "\niterations\t" + str(stats["n"])
+results_str += "\nerror mean\t" + str(error_log_mean)
+results_str += "\nerror sum\t" + str(error_log_sum)
+results_str += "\nerror percent\t" + str(error_log_percent)
+
+fout_results = open(dir_working+"/results.tsv", "w")
+fout_results.write(results_str)
+fout_results.close()
+
+
+# json record based on first run with merged values
+mops = merge_json
+
+for field in run_fields:
+    mops.pop(field, None)
+
+mops["Ts"] = Ts
+mops["Rid"] = Rid
+mops["dir_working"] = dir_working
+mops["iterations"] = stats["n"]
+mops["error_log_mean"] = error_log_mean
+mops["error_log_sum"] = error_log_sum
+mops["error_log_percent"] = error_log_percent
+mops["merged"] = merge_rids
+mops["merged_iterations"] = [run["stats"]["n"] for run in runs]
+mops["run_seed"] = run_seed
+
+json_handle = open(json_path(Rid), 'w')
+json.dump(mops, json_handle, sort_keys = True, indent = 4, ensure_ascii=False)
+json_handle.close()
+
+
+print("runmerge.py - merged " + str(len(runs)) + " runs (" + str(stats["n"]) + " iterations) into " + Rid)
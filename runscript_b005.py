@@ -9,22 +9,34 @@
 
 from __future__ import print_function
 
-from mpi4py import MPI
+# mpi4py is optional, without it the script runs on a single machine using the local backend
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
 
 import os
 import sys
 import errno
+import shutil
 from copy import deepcopy
 import time
 import random
 import math
+import traceback
 
 import json
 import hashlib
 
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 import pandas as pd
 from shapely.geometry import Polygon, Point, shape, box
+from shapely.prepared import prep
+from shapely.ops import unary_union
+from shapely import wkb
 import shapefile
 
 
@@ -33,11 +45,64 @@ import shapefile
 # general init
 
 
-# mpi info
-comm = MPI.COMM_WORLD
-size = comm.Get_size()
-rank = comm.Get_rank()
-status = MPI.Status()
+# single process stand in for mpi communicator when mpi4py is not available
+class LocalComm(object):
+
+    def Get_size(self):
+        return 1
+
+    def Get_rank(self):
+        return 0
+
+    def bcast(self, obj, root=0):
+        return obj
+
+    def Barrier(self):
+        pass
+
+    def Abort(self, errorcode=0):
+        sys.exit(errorcode)
+
+
+# message status for local backend
+class LocalStatus(object):
+
+    def __init__(self):
+        self.source = 0
+        self.tag = 0
+
+    def Get_source(self):
+        return self.source
+
+    def Get_tag(self):
+        return self.tag
+
+
+if MPI is not None:
+
+    # mpi info
+    comm = MPI.COMM_WORLD
+    size = comm.Get_size()
+    rank = comm.Get_rank()
+    status = MPI.Status()
+
+    # ranks sharing a node (and its memory)
+    node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED, key=rank)
+    node_rank = node_comm.Get_rank()
+
+    # first rank on each node
+    leader_comm = comm.Split(0 if node_rank == 0 else MPI.UNDEFINED, rank)
+
+else:
+
+    comm = LocalComm()
+    size = 1
+    rank = 0
+    status = LocalStatus()
+
+    node_comm = comm
+    node_rank = 0
+    leader_comm = comm
 
 # absolute path to script directory
 dir_base = os.path.dirname(os.path.abspath(__file__))
@@ -57,13 +122,11 @@ Ts = int(time.time())
 random_id = '{0:05d}'.format(int(random.random() * 10**5))
 Rid = "mcr_" + str(Ts) +"_"+ random_id
 
-Rid = "mcr_" + str(Ts) +"_"+ "56789"
-
 
 # --------------------------------------------------
 # input arguments
 
-# python /path/to/runscript.py nepal NPL 0.1 10
+# python /path/to/runscript.py nepal NPL 0.1 [backend] [Rid] [extend]
 arg = sys.argv
 
 try:
@@ -77,11 +140,85 @@ try:
     # raw_filter = sys.argv[5]
 
     # force_mean_surf = int(sys.argv[x])
+    # also regenerates cached unit surfaces of the run's geometries
     force_mean_surf = 0
 
     # only run mean surf
     mean_surf_only = 0
 
+    # overlap mean surf and iterations (iteration error checks wait for mean surf)
+    surf_pipeline = 0
+
+    # hold read only location and geometry data once per node in shared memory
+    node_shared = 0
+
+    # index iteration rasters by only the grid cells which can receive aid (within country
+    # or a location geometry) instead of every cell in country bounding box
+    compact_cells = 0
+
+    # split grid into row bands owned by the last iter_tiles ranks (0 disables)
+    # tile ranks hold iteration statistics and write outputs for their band only
+    iter_tiles = 0
+
+    # execution backend
+    #   "mpi" - one mpi rank per core, every rank other than master is a worker
+    #   "hybrid" - one mpi rank per node, each worker rank runs tasks on a local pool
+    #   "local" - single process (no mpiexec) which runs tasks on a local pool
+    backend = "mpi"
+    if len(sys.argv) > 4:
+        backend = sys.argv[4]
+
+    # hybrid and local backend pool size (0 uses all cores) and type ("process" or "thread")
+    pool_size = 0
+    pool_type = "process"
+
+    # hybrid backend and sub-master iterations per task batch
+    iter_batch = 32
+
+    # ranks in each group served by a sub-master during iterations (0 disables, -1 for a group per node)
+    # sub-masters pull batches of iterations from master, hand them to the workers of their group
+    # and send master the combined statistics of each batch (mpi backend only)
+    group_size = 0
+
+    # iteration tasks queued at each worker ahead of the task it is running (0 disables)
+    # workers receive their next task while running the current one and only ask for tasks once,
+    # every result sent to master frees a slot for another task (mpi and hybrid backends)
+    task_prefetch = 0
+
+    # seconds master waits between polls for worker messages when idle (task_prefetch, task_timeout or task_speculate)
+    task_poll = 0.001
+
+    # seconds without any message from a worker which has tasks before it is treated as lost (0 disables)
+    # tasks of lost workers are run again by other workers
+    task_timeout = 0
+
+    # failed tasks after which a worker is quarantined (sent no more tasks)
+    task_failures_max = 3
+
+    # multiple of median task time after which a copy of a running task is sent to a free worker (0 disables)
+    # copies are only sent near the end of a phase or when the task holds up the next error check,
+    # whichever copy returns first is used and the result of the other is dropped
+    task_speculate = 0
+
+    # task times needed for the median before any copies are sent
+    task_speculate_min = 10
+
+    # run id of an interrupted run to resume from its last checkpoint
+    # or of a finished run to extend
+    run_existing = 0
+    if len(sys.argv) > 5:
+        Rid = sys.argv[5]
+        run_existing = 1
+
+    # seed of iteration random streams (None generates a new seed)
+    # resumed and extended runs use the seed of the original run
+    run_seed = None
+
+    # number of iterations to add to finished run (0 for a new run)
+    iter_extend = 0
+    if len(sys.argv) > 6:
+        iter_extend = int(sys.argv[6])
+
     # run_mean_surf = int(sys.argv[8])
     # run_mean_surf = 3
     # path_mean_surf = "data/nepal/nepal_0.5_1432844232_12347/outputs/output_nepal_0.5_surf.npy"
@@ -97,6 +234,105 @@ except:
     sys.exit("invalid inputs")
 
 
+# ranks may start at different times, rank 0 run id is used everywhere
+Rid = comm.bcast(Rid, root=0)
+
+# local backend is always used without mpi4py
+if MPI is None:
+    backend = "local"
+
+if backend not in ["mpi", "hybrid", "local"]:
+    sys.exit("invalid backend: "+str(backend))
+
+if backend == "local" and size > 1:
+    sys.exit("local backend does not run with multiple mpi ranks")
+
+# nothing to share with a single process
+# local pool tasks are already queued
+if backend == "local":
+    node_shared = 0
+    task_prefetch = 0
+    task_timeout = 0
+    task_speculate = 0
+
+if iter_tiles > 0 and (backend == "local" or size < iter_tiles + 2):
+    sys.exit("iter_tiles requires mpi ranks for master, tiles and at least one worker")
+
+if group_size != 0 and (backend != "mpi" or iter_tiles > 0):
+    sys.exit("group_size requires mpi backend without iter_tiles")
+
+# sub-masters only hand out iteration tasks
+if group_size != 0 and surf_pipeline == 1:
+    sys.exit("surf_pipeline can not be used with group_size")
+
+# tile ranks need the mean surface before iterations start
+if iter_tiles > 0 and surf_pipeline == 1:
+    sys.exit("surf_pipeline can not be used with iter_tiles")
+
+# sub-masters already request batches ahead
+if task_prefetch > 0 and group_size != 0:
+    sys.exit("task_prefetch can not be used with group_size")
+
+# number of workers master hands tasks to (local backend workers are pool processes)
+# tile ranks are not workers
+if backend == "local":
+    task_workers = pool_size if pool_size > 0 else multiprocessing.cpu_count()
+else:
+    task_workers = size - 1 - iter_tiles
+
+
+# groups of ranks served by a sub-master (first rank of each group) during iterations
+# groups are consecutive ranks or ranks sharing a node, excluding master
+# a rank without any others in its group joins a neighbouring group
+if group_size != 0:
+
+    if group_size > 0:
+        tmp_keys = [0] + [(r - 1) // group_size for r in range(1, size)]
+    else:
+        tmp_keys = comm.allgather(node_comm.bcast(rank, root=0))
+
+    tmp_groups = {}
+    for r in range(1, size):
+        tmp_groups.setdefault(tmp_keys[r], []).append(r)
+
+    group_ranks = sorted(tmp_groups.values())
+
+    while len(group_ranks) > 1 and min(len(g) for g in group_ranks) < 2:
+        g = [len(g) for g in group_ranks].index(min(len(g) for g in group_ranks))
+        tmp_merge = group_ranks.pop(g)
+        group_ranks[max(g - 1, 0)] = sorted(group_ranks[max(g - 1, 0)] + tmp_merge)
+
+    if len(group_ranks[0]) < 2:
+        sys.exit("group_size requires at least two ranks other than master")
+
+    # ranks master hands iteration tasks to
+    iter_workers = [g[0] for g in group_ranks]
+
+else:
+    group_ranks = []
+    iter_workers = list(range(1, task_workers+1))
+
+
+# --------------------------------------------------
+# mean surface cache options
+
+# mean surfaces are cached by a hash of every input that determines them
+# least recently used surfaces are evicted once either limit is exceeded
+
+# max number of cached mean surfaces
+surf_cache_max_count = 50
+
+# max total size of cached mean surfaces (in bytes)
+surf_cache_max_size = 2 * 1024**3
+
+# version of mean surface generation, changing it invalidates existing cache entries
+surf_cache_version = 2
+
+# mean surface tasks are sent out in order of estimated cost (largest first)
+# geometries whose poly grid has more points than this are split into tiles of poly grid rows
+surf_tile_points = 250000
+
+
 # --------------------------------------------------
 # iteration and pixel size options
 
@@ -121,6 +357,35 @@ iter_thresh = 0.05
 # minimum improvement over previous iteration interval required to continue (decimal percentage)
 iter_improvement = 0.001
 
+# seconds between checkpoints of iteration state (0 disables checkpoints)
+checkpoint_interval = 300
+
+# how locations of polygon geometries are placed each iteration
+#   "point" - random point within geometry, rounded to its grid cell
+#   "alias" - grid cell drawn from geometry coverage (unit surface) using alias tables
+# alias sampling needs unit surfaces before iterations start so it can not be used with surf_pipeline
+iter_sampling = "alias"
+
+if iter_sampling not in ["point", "alias"]:
+    sys.exit("invalid iter_sampling: "+str(iter_sampling))
+
+if iter_sampling == "alias" and surf_pipeline == 1:
+    sys.exit("surf_pipeline requires iter_sampling = point")
+
+# dtype of iteration aid and count rasters computed by workers and sent to master
+#   "int64" - whole dollars only (legacy, shares under a dollar are dropped)
+#   "float32" - half the memory and message size of float64
+#   "float64" - exact dollar amounts
+# statistics of iterations are always accumulated as float64
+iter_dtype = "float64"
+
+if iter_dtype not in ["int64", "float32", "float64"]:
+    sys.exit("invalid iter_dtype: "+str(iter_dtype))
+
+# with alias sampling, cells of geometries shared by at least this many locations
+# are drawn for all of them at once (multinomial cell counts assigned to locations in random order)
+iter_group_min = 32
+
 
 # check for valid pixel size
 # examples of valid pixel sizes: 1.0, 0.5, 0.25, 0.2, 0.1, 0.05, 0.025, ...
@@ -191,6 +456,15 @@ lookup = {
     "8": {"type":"adm","data":"0"}
 }
 
+# --------------------------------------------------
+# geometry reference levels
+# references >= 0 are adm levels
+
+geom_none = -1
+geom_point = -2
+geom_buffer = -3
+
+
 # --------------------------------------------------
 # file paths
 
@@ -202,6 +476,27 @@ dir_chain = dir_country+"/"+country+"_"+str(data_version)+"_"+run_id+"_"+str(pix
 dir_outputs = dir_chain+"/outputs"
 dir_working = dir_outputs+"/"+str(Rid)
 
+# a given run id must be of an interrupted run with a checkpoint or of a finished run being extended
+# (a new run in its directory would overwrite its outputs)
+if run_existing and not os.path.isdir(dir_working):
+    sys.exit("no run to resume or extend: "+str(Rid))
+
+if run_existing and iter_extend == 0 and not os.path.isfile(dir_working+"/checkpoint.npz"):
+    if os.path.isfile(dir_working+"/stats.npz"):
+        sys.exit("run is finished, give number of iterations to extend it: "+str(Rid))
+    sys.exit("no checkpoint to resume run from: "+str(Rid))
+
+# statistics of a run are saved with its outputs and can be extended
+if iter_extend > 0 and not os.path.isfile(dir_working+"/stats.npz"):
+    sys.exit("no statistics to extend for run: "+str(Rid))
+
+# statistics of tiled runs are split between tile ranks (see stats_tile files)
+if iter_extend > 0 and iter_tiles > 0:
+    sys.exit("tiled runs can not be extended")
+
+dir_surf_cache = dir_base+"/data/surf_cache"
+dir_unit_cache = dir_base+"/data/unit_cache"
+
 
 # ====================================================================================================
 # ====================================================================================================
@@ -211,11 +506,20 @@ dir_working = dir_outputs+"/"+str(Rid)
 def json_hash(hash_obj):
     hash_json = json.dumps(hash_obj, sort_keys = True, ensure_ascii = False)
     hash_builder = hashlib.md5()
-    hash_builder.update(hash_json)
+    hash_builder.update(hash_json.encode('utf-8'))
     hash_md5 = hash_builder.hexdigest()
     return hash_md5
 
 
+# md5 of file contents
+def file_hash(path):
+    hash_builder = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            hash_builder.update(chunk)
+    return hash_builder.hexdigest()
+
+
 # creates directories
 def make_dir(path):
     try:
@@ -228,6 +532,437 @@ def make_dir(path):
 # --------------------------------------------------
 
 
+# paths of npy and metadata files for a mean surface cache entry
+def surfCachePaths(surf_hash):
+    npy_path = dir_surf_cache+"/"+surf_hash+".npy"
+    meta_path = dir_surf_cache+"/"+surf_hash+".json"
+    return npy_path, meta_path
+
+
+# remove a mean surface cache entry
+def surfCacheRemove(surf_hash):
+    for path in surfCachePaths(surf_hash):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+# load mean surface from cache
+# returns None if surface is not cached or fails integrity check
+def surfCacheLoad(surf_hash, surf_size):
+    npy_path, meta_path = surfCachePaths(surf_hash)
+
+    if not os.path.isfile(npy_path) or not os.path.isfile(meta_path):
+        return None
+
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+        if file_hash(npy_path) != meta["md5"]:
+            raise ValueError("checksum mismatch")
+
+        surf = np.load(npy_path)
+
+        if surf.shape != (surf_size,):
+            raise ValueError("shape mismatch")
+
+    except Exception as e:
+        print("surfCacheLoad - discarding cache entry " + surf_hash + " (" + str(e) + ")")
+        surfCacheRemove(surf_hash)
+        return None
+
+    # metadata file mtime tracks last use for lru eviction
+    os.utime(meta_path, None)
+
+    return surf
+
+
+# save mean surface to cache and evict old entries
+# files are written to temp paths and renamed so partial entries are never read
+# temp paths include run id so concurrent runs saving the same entry do not write to the same file
+def surfCacheSave(surf_hash, surf, surf_inputs):
+    make_dir(dir_surf_cache)
+    npy_path, meta_path = surfCachePaths(surf_hash)
+
+    npy_tmp = npy_path + "." + str(Rid) + ".tmp"
+    meta_tmp = meta_path + "." + str(Rid) + ".tmp"
+
+    with open(npy_tmp, 'wb') as f:
+        np.save(f, surf)
+
+    meta = {
+        "surf_hash": surf_hash,
+        "md5": file_hash(npy_tmp),
+        "size": os.path.getsize(npy_tmp),
+        "inputs": surf_inputs,
+        "created": int(time.time())
+    }
+
+    with open(meta_tmp, 'w') as f:
+        json.dump(meta, f, sort_keys = True, indent = 4)
+
+    os.rename(npy_tmp, npy_path)
+    os.rename(meta_tmp, meta_path)
+
+    surfCacheEvict(surf_cache_max_count, surf_cache_max_size)
+
+
+# evict least recently used mean surfaces until cache is within count and size limits
+def surfCacheEvict(max_count, max_size):
+    entries = []
+    for name in os.listdir(dir_surf_cache):
+        if not name.endswith(".json"):
+            continue
+
+        tmp_hash = name[:-5]
+        npy_path, meta_path = surfCachePaths(tmp_hash)
+
+        if not os.path.isfile(npy_path):
+            surfCacheRemove(tmp_hash)
+            continue
+
+        entries.append((os.path.getmtime(meta_path), os.path.getsize(npy_path), tmp_hash))
+
+    entries.sort(reverse=True)
+
+    total_count = 0
+    total_size = 0
+    for (tmp_mtime, tmp_size, tmp_hash) in entries:
+        total_count += 1
+        total_size += tmp_size
+
+        if total_count > max_count or total_size > max_size:
+            print("surfCacheEvict - evicting " + tmp_hash)
+            surfCacheRemove(tmp_hash)
+
+
+# --------------------------------------------------
+
+
+# unit surface cache
+#
+# holds the normalized grid coverage of every unique geometry seen for a country and pixel size
+# as a sparse (geometry x cell) matrix in csr form:
+#   keys - geometry keys (see geomKey), one per matrix row
+#   indptr - row offsets into cells and weights
+#   cells - grid cell index
+#   weights - fraction of the geometry covering the cell (each row sums to 1)
+
+
+# path of unit surface cache file for country and pixel size
+def unitCachePath():
+    return dir_unit_cache+"/"+country+"_"+str(pixel_size)+".npz"
+
+
+# grid definition unit surfaces are only valid for
+def unitCacheGrid():
+    return np.array([adm0_minx, adm0_miny, adm0_maxx, adm0_maxy, pixel_size, len(rows), len(cols)])
+
+
+# empty unit surface matrix
+def unitEmpty():
+    return {
+        "keys": [],
+        "indptr": np.zeros((1,), dtype=np.int64),
+        "cells": np.zeros((0,), dtype=np.int64),
+        "weights": np.zeros((0,), dtype=np.float64)
+    }
+
+
+# checksum of unit surface matrix contents
+def unitChecksum(unit):
+    hash_builder = hashlib.md5()
+    hash_builder.update("\n".join(unit["keys"]).encode("utf-8"))
+    for f in ["indptr", "cells", "weights"]:
+        hash_builder.update(np.ascontiguousarray(unit[f]).tobytes())
+    return hash_builder.hexdigest()
+
+
+# load unit surface matrix from cache
+# returns an empty matrix if cache does not exist, is not valid for current grid or fails its checksum
+def unitCacheLoad():
+    path = unitCachePath()
+
+    if not os.path.isfile(path):
+        return unitEmpty()
+
+    try:
+        npz = np.load(path)
+
+        if npz["grid"].shape != unitCacheGrid().shape or not np.allclose(npz["grid"], unitCacheGrid()):
+            raise ValueError("grid mismatch")
+
+        unit = {
+            "keys": [str(k) for k in npz["keys"]],
+            "indptr": npz["indptr"],
+            "cells": npz["cells"],
+            "weights": npz["weights"]
+        }
+
+        if len(unit["indptr"]) != len(unit["keys"]) + 1 or unit["indptr"][-1] != len(unit["cells"]):
+            raise ValueError("inconsistent arrays")
+
+        if str(npz["md5"]) != unitChecksum(unit):
+            raise ValueError("checksum mismatch")
+
+    except Exception as e:
+        print("unitCacheLoad - discarding unit cache " + path + " (" + str(e) + ")")
+        return unitEmpty()
+
+    return unit
+
+
+# save unit surface matrix to cache
+# written to a temp path (including run id, so concurrent runs do not share it) and renamed
+def unitCacheSave(unit):
+    make_dir(dir_unit_cache)
+    path = unitCachePath()
+    tmp_path = path + "." + str(Rid) + ".tmp"
+
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, grid=unitCacheGrid(), keys=np.array(unit["keys"], dtype=str),
+                 indptr=unit["indptr"], cells=unit["cells"], weights=unit["weights"], md5=unitChecksum(unit))
+
+    os.rename(tmp_path, path)
+
+
+# add rows to unit surface matrix
+# new_rows is a list of (key, cells, counts) tuples, counts are normalized to weights
+# tuples with the same key (tiles of a geometry) are combined into a single row
+def unitAppend(unit, new_rows):
+    if len(new_rows) == 0:
+        return unit
+
+    key_order = []
+    key_parts = {}
+    for (key, cells, counts) in new_rows:
+        if key not in key_parts:
+            key_order.append(key)
+            key_parts[key] = []
+        key_parts[key].append((cells, counts))
+
+    new_rows = []
+    for key in key_order:
+        tmp_cells = np.concatenate([np.asarray(cells, dtype=np.int64) for (cells, counts) in key_parts[key]])
+        tmp_counts = np.concatenate([np.asarray(counts, dtype=np.float64) for (cells, counts) in key_parts[key]])
+        tmp_unique, tmp_inverse = np.unique(tmp_cells, return_inverse=True)
+        new_rows.append((key, tmp_unique, np.bincount(tmp_inverse, weights=tmp_counts, minlength=len(tmp_unique))))
+
+    new_cells = [np.asarray(cells, dtype=np.int64) for (key, cells, counts) in new_rows]
+    new_weights = []
+    for (key, cells, counts) in new_rows:
+        counts = np.asarray(counts, dtype=np.float64)
+        if counts.sum() > 0:
+            counts = counts / counts.sum()
+        new_weights.append(counts)
+
+    new_lengths = np.array([len(cells) for cells in new_cells], dtype=np.int64)
+
+    return {
+        "keys": unit["keys"] + [key for (key, cells, counts) in new_rows],
+        "indptr": np.concatenate((unit["indptr"], unit["indptr"][-1] + np.cumsum(new_lengths))),
+        "cells": np.concatenate([unit["cells"]] + new_cells),
+        "weights": np.concatenate([unit["weights"]] + new_weights)
+    }
+
+
+# remove rows of keys from unit surface matrix
+def unitRemove(unit, keys):
+    keep = np.array([k not in keys for k in unit["keys"]], dtype=bool)
+    lengths = np.diff(unit["indptr"])
+
+    nnz_keep = np.repeat(keep, lengths)
+
+    return {
+        "keys": [k for (k, tmp_keep) in zip(unit["keys"], keep) if tmp_keep],
+        "indptr": np.concatenate(([0], np.cumsum(lengths[keep]))).astype(np.int64),
+        "cells": unit["cells"][nnz_keep],
+        "weights": unit["weights"][nnz_keep]
+    }
+
+
+# mean surface as product of unit surface matrix and vector of aid totals per geometry
+# geom_totals is a series of aid totals indexed by geometry key
+def unitSurf(unit, geom_totals, surf_size):
+    key_index = dict((k, i) for i, k in enumerate(unit["keys"]))
+
+    totals = np.zeros((len(unit["keys"]),), dtype=np.float64)
+    for k, v in zip(geom_totals.index, geom_totals.values):
+        totals[key_index[k]] += v
+
+    nnz_rows = np.repeat(np.arange(len(unit["keys"])), np.diff(unit["indptr"]))
+
+    return np.bincount(unit["cells"], weights=unit["weights"] * totals[nnz_rows], minlength=surf_size)
+
+
+# --------------------------------------------------
+
+
+# mpi shared memory windows backing node shared arrays
+# kept referenced so windows stay allocated for lifetime of run
+shared_windows = []
+
+
+# read only array held once per node in mpi shared memory
+# array only needs to be provided by first rank on node, other ranks on node map the same memory
+# returns array unchanged when node_shared is off
+def nodeShared(arr):
+    if not node_shared:
+        return arr
+
+    if node_rank == 0:
+        arr = np.ascontiguousarray(arr)
+        if arr.dtype.hasobject:
+            sys.exit("nodeShared - object arrays can not be shared")
+        arr_meta = (arr.shape, arr.dtype.str)
+    else:
+        arr_meta = None
+
+    (arr_shape, arr_dtype) = node_comm.bcast(arr_meta, root=0)
+    arr_dtype = np.dtype(arr_dtype)
+    arr_bytes = int(np.prod(arr_shape)) * arr_dtype.itemsize
+
+    win = MPI.Win.Allocate_shared(max(arr_bytes, 1) if node_rank == 0 else 0, arr_dtype.itemsize, comm=node_comm)
+    buf, itemsize = win.Shared_query(0)
+    shared_arr = np.ndarray(buffer=buf, dtype=arr_dtype, shape=arr_shape)
+
+    if node_rank == 0:
+        shared_arr[...] = arr
+
+    node_comm.Barrier()
+
+    shared_arr.flags.writeable = False
+    shared_windows.append(win)
+
+    return shared_arr
+
+
+# rows of array as a new node shared array
+# selection is only made by first rank on node
+def nodeTake(arr, sel):
+    return nodeShared(arr[sel] if node_rank == 0 or not node_shared else None)
+
+
+# concatenated wkb of geometries as uint8 array and array of offsets
+def packWkb(geoms):
+    geom_wkb = [g.wkb for g in geoms]
+    offsets = np.concatenate(([0], np.cumsum([len(g) for g in geom_wkb]))).astype(np.int64)
+    return np.frombuffer(b''.join(geom_wkb), dtype=np.uint8), offsets
+
+
+# geometry i from packWkb arrays
+def unpackWkb(buf, offsets, i):
+    return wkb.loads(buf[offsets[i]:offsets[i+1]].tobytes())
+
+
+# --------------------------------------------------
+
+
+# sufficient statistics of iteration aid and count rasters
+# per cell sums and sums of squares along with the number of iterations
+def statsNew(n_cells):
+    return {
+        "n": 0,
+        "aid_sum": np.zeros((n_cells,), dtype=np.float64),
+        "aid_sumsq": np.zeros((n_cells,), dtype=np.float64),
+        "count_sum": np.zeros((n_cells,), dtype=np.float64),
+        "count_sumsq": np.zeros((n_cells,), dtype=np.float64)
+    }
+
+
+# add single iteration result (aid and count rasters) to statistics
+def statsAdd(stats, npa_result):
+    npa_aid = np.asarray(npa_result[0], dtype=np.float64)
+    npa_count = np.asarray(npa_result[1], dtype=np.float64)
+
+    stats["n"] += 1
+    stats["aid_sum"] += npa_aid
+    stats["aid_sumsq"] += npa_aid**2
+    stats["count_sum"] += npa_count
+    stats["count_sumsq"] += npa_count**2
+
+
+# add statistics of other iterations to statistics
+def statsMerge(stats, other):
+    stats["n"] += other["n"]
+    for field in ["aid_sum", "aid_sumsq", "count_sum", "count_sumsq"]:
+        stats[field] += other[field]
+
+
+# copy of statistics
+def statsCopy(stats):
+    return dict((k, v.copy() if isinstance(v, np.ndarray) else v) for (k, v) in stats.items())
+
+
+# add single iteration result for some cells to statistics
+# cells must be unique, other cells add zero
+def statsAddCells(stats, cells, npa_result):
+    npa_aid = np.asarray(npa_result[0], dtype=np.float64)
+    npa_count = np.asarray(npa_result[1], dtype=np.float64)
+
+    stats["n"] += 1
+    stats["aid_sum"][cells] += npa_aid
+    stats["aid_sumsq"][cells] += npa_aid**2
+    stats["count_sum"][cells] += npa_count
+    stats["count_sumsq"][cells] += npa_count**2
+
+
+# mean, standard deviation and variance for "aid" or "count" from statistics
+def statsResult(stats, prefix):
+    tmp_mean = stats[prefix+"_sum"] / stats["n"]
+    tmp_var = np.maximum(stats[prefix+"_sumsq"] / stats["n"] - tmp_mean**2, 0)
+    return tmp_mean, np.sqrt(tmp_var), tmp_var
+
+
+# path of iteration checkpoint for run
+def checkpointPath():
+    return dir_working+"/checkpoint.npz"
+
+
+# path of final iteration statistics for run (saved with asc outputs)
+def statsPath():
+    return dir_working+"/stats.npz"
+
+
+# save iteration statistics, run seed and error checks done
+# statistics are saved for full grid so runs can be merged regardless of compact_cells
+# written to temp file and renamed so an interrupted save never replaces an existing file
+def iterStateSave(path, stats, seed, checks):
+    meta = {
+        "Rid": Rid,
+        "n": stats["n"],
+        "seed": seed,
+        "checks": checks,
+        "saved": int(time.time())
+    }
+
+    with open(path+".tmp", 'wb') as f:
+        np.savez(f, meta=np.array(json.dumps(meta)),
+                 aid_sum=cellFull(stats["aid_sum"]), aid_sumsq=cellFull(stats["aid_sumsq"]),
+                 count_sum=cellFull(stats["count_sum"]), count_sumsq=cellFull(stats["count_sumsq"]))
+
+    os.rename(path+".tmp", path)
+
+
+# load iteration state saved by iterStateSave
+# returns None if file does not exist
+def iterStateLoad(path):
+    if not os.path.isfile(path):
+        return None
+
+    with np.load(path) as f:
+        meta = json.loads(str(f["meta"]))
+
+        stats = {"n": meta["n"]}
+        for field in ["aid_sum", "aid_sumsq", "count_sum", "count_sumsq"]:
+            stats[field] = cellCompact(f[field])
+
+    return stats, meta["seed"], meta["checks"]
+
+
+# --------------------------------------------------
+
+
 # check csv delim and return if valid type
 def getCSV(path):
     if path.endswith('.tsv'):
@@ -314,13 +1049,12 @@ def geomType(is_geo, code):
 
 
 # finds shape in set of polygons which arbitrary polygon is within
-# returns 0 if item is not within any of the shapes
+# returns index of shape or -1 if item is not within any of the shapes
 def getPolyWithin(item, polys):
-    c = 0
-    for shp in polys:
-        tmp_shp = shape(shp)
-        if item.within(tmp_shp):
-            return tmp_shp
+    c = -1
+    for i, shp in enumerate(polys):
+        if item.within(shp):
+            return i
 
     return c
 
@@ -332,7 +1066,8 @@ def inCountry(shp):
 
 
 # build geometry for point based on code
-# depends on lookup and adm0
+# depends on lookup, adm_shps and adm0
+# returns geometry reference (see geomVal) or 0
 def getGeom(code, lon, lat):
     tmp_pnt = Point(lon, lat)
 
@@ -341,7 +1076,7 @@ def getGeom(code, lon, lat):
         return 0
 
     elif lookup[code]["type"] == "point":
-        return tmp_pnt
+        return (geom_point, -1, tmp_pnt)
 
     elif lookup[code]["type"] == "buffer":
         try:
@@ -349,9 +1084,9 @@ def getGeom(code, lon, lat):
             tmp_buffer = tmp_pnt.buffer(tmp_int)
 
             if inCountry(tmp_buffer):
-                return tmp_buffer
+                return (geom_buffer, -1, tmp_buffer)
             else:
-                return tmp_buffer.intersection(adm0)
+                return (geom_buffer, -1, tmp_buffer.intersection(adm0))
 
         except:
             print("buffer value could not be converted to float")
@@ -360,7 +1095,12 @@ def getGeom(code, lon, lat):
     elif lookup[code]["type"] == "adm":
         try:
             tmp_int = int(lookup[code]["data"])
-            return getPolyWithin(tmp_pnt, adm_shps[tmp_int])
+            tmp_item = getPolyWithin(tmp_pnt, adm_shps[tmp_int])
+
+            if tmp_item != -1:
+                return (tmp_int, tmp_item, adm_shps[tmp_int][tmp_item])
+
+            return 0
 
         except:
             print("adm value could not be converted to int")
@@ -371,33 +1111,67 @@ def getGeom(code, lon, lat):
         return 0
 
 
-# returns geometry for point
+# returns geometry reference for point as (level, item, geometry) tuple
+# level is the adm level and item the index of the adm shape for adm geometries,
+# otherwise one of geom_point, geom_buffer or geom_none
 # depends on agg_types and adm0
 def geomVal(agg_type, code, lon, lat):
     if agg_type in agg_types:
 
-        code = str(int(code))
+        code = str(int(float(code)))
         tmp_geom = getGeom(code, lon, lat)
 
         if tmp_geom != 0:
             return tmp_geom
 
-        return "None"
+        return (geom_none, -1, None)
 
     elif agg_type == "country":
 
-        return adm0
+        return (0, 0, adm0)
 
     else:
         print("agg_type not recognized: " + str(agg_type))
-        return "None"
+        return (geom_none, -1, None)
+
+
+# geometry references for a shard of the location rows
+# returns arrays of reference levels, reference items, grid cell indices (points only),
+# and wkb lengths (buffers only) along with the concatenated buffer wkb
+def geomShard(loc_rows, shard_start, shard_end):
+    shard_size = shard_end - shard_start
+
+    shard_level = np.zeros((shard_size,), dtype=np.int32) + geom_none
+    shard_item = np.zeros((shard_size,), dtype=np.int32) - 1
+    shard_cell = np.zeros((shard_size,), dtype=np.int64) - 1
+    shard_length = np.zeros((shard_size,), dtype=np.int64)
+    shard_wkb = []
+
+    for j in range(shard_size):
+        i = shard_start + j
+        (tmp_level, tmp_item, tmp_geom) = geomVal(loc_rows["agg_type"][i], loc_rows[code_field][i], loc_rows["longitude"][i], loc_rows["latitude"][i])
+
+        shard_level[j] = tmp_level
+        shard_item[j] = tmp_item
+
+        if tmp_level == geom_point:
+            shard_cell[j] = gridIdx(tmp_geom.x, tmp_geom.y)
+
+        elif tmp_level == geom_buffer:
+            tmp_wkb = tmp_geom.wkb
+            shard_length[j] = len(tmp_wkb)
+            shard_wkb.append(tmp_wkb)
+
+    shard_wkb = np.frombuffer(b''.join(shard_wkb), dtype=np.uint8)
+
+    return shard_level, shard_item, shard_cell, shard_length, shard_wkb
 
 
 # --------------------------------------------------
 
 
 # random point gen function
-def get_random_point_in_polygon(poly):
+def get_random_point_in_polygon(poly, rng):
 
     INVALID_X = -9999
     INVALID_Y = -9999
@@ -406,117 +1180,257 @@ def get_random_point_in_polygon(poly):
     p = Point(INVALID_X, INVALID_Y)
     px = 0
     while not poly.contains(p):
-        p_x = random.uniform(minx, maxx)
-        p_y = random.uniform(miny, maxy)
+        p_x = rng.uniform(minx, maxx)
+        p_y = rng.uniform(miny, maxy)
         p = Point(p_x, p_y)
     return p
 
 
 # generate random point geom or use actual point
-def addPt(agg_type, agg_geom):
+def addPt(agg_type, agg_geom, rng):
     if agg_type == "point":
         return agg_geom
     else:
-        tmp_rnd = get_random_point_in_polygon(agg_geom)
+        tmp_rnd = get_random_point_in_polygon(agg_geom, rng)
         return tmp_rnd
 
 
-# ====================================================================================================
-# ====================================================================================================
+# --------------------------------------------------
 
 
-# --------------------------------------------------
-# load shapefiles
+# unique key for geometry based on its wkb
+def geomKey(geom):
+    return hashlib.md5(geom.wkb).hexdigest()
 
-# must start at and inlcude ADM0
-# all additional ADM shps must be included so that adm_path index corresponds to adm level
-adm_paths = []
-adm_paths.append(dir_base+"/countries/"+country+"/shapefiles/ADM0/"+abbr+"_adm0.shp")
-adm_paths.append(dir_base+"/countries/"+country+"/shapefiles/ADM1/"+abbr+"_adm1.shp")
-adm_paths.append(dir_base+"/countries/"+country+"/shapefiles/ADM2/"+abbr+"_adm2.shp")
 
-# get adm0 bounding box
-adm_shps = [shapefile.Reader(adm_path).shapes() for adm_path in adm_paths]
+# geometry of location (i_m row)
+# adm shapes are shared by all rows referencing them, buffers are unpacked from the gathered wkb when used
+# points have no geometry (cell is used)
+def locGeom(i):
+    if geom_level[i] >= 0:
+        return adm_shps[geom_level[i]][geom_item[i]]
+    elif geom_level[i] == geom_buffer:
+        return wkb.loads(geom_wkb[geom_start[i]:geom_end[i]].tobytes())
+    else:
+        return None
 
-# define country shape
-adm0 = shape(adm_shps[0][0])
 
+# round half away from zero (matches python 2 round)
+def roundHalf(x):
+    x = np.asarray(x, dtype=np.float64)
+    return np.sign(x) * np.floor(np.abs(x) + 0.5)
 
-# --------------------------------------------------
-# create point grid for country
 
-# country bounding box
-(adm0_minx, adm0_miny, adm0_maxx, adm0_maxy) = adm0.bounds
-# print( (adm0_minx, adm0_miny, adm0_maxx, adm0_maxy) )
+# output grid cell indices for coordinates
+# coordinates are rounded to nearest grid point
+def gridIdx(lon, lat):
+    grid_c = roundHalf(np.asarray(lon) * psi) - roundHalf(adm0_minx * psi)
+    grid_r = roundHalf(adm0_maxy * psi) - roundHalf(np.asarray(lat) * psi)
+    return (grid_r * len(cols) + grid_c).astype(np.int64)
 
-# grid_buffer
-gb = 0.5
 
-# bounding box rounded to pixel size (always increases bounding box size, never decreases)
-(adm0_minx, adm0_miny, adm0_maxx, adm0_maxy) = (math.floor(adm0_minx*gb)/gb, math.floor(adm0_miny*gb)/gb, math.ceil(adm0_maxx*gb)/gb, math.ceil(adm0_maxy*gb)/gb)
-# print( (adm0_minx, adm0_miny, adm0_maxx, adm0_maxy) )
+# grid cells which can receive aid
+# cells intersecting country or any polygon location geometry, and cells of point locations
+def gridMask(geoms, point_cells):
+    mask_geom = unary_union([adm0] + list(geoms))
 
-# generate arrays of new grid x and y values
-cols = np.arange(adm0_minx, adm0_maxx+pixel_size*0.5, pixel_size)
-rows = np.arange(adm0_maxy, adm0_miny-pixel_size*0.5, -1*pixel_size)
+    mask = np.zeros((int(idx+1),), dtype=bool)
+    mask[point_cells] = True
 
-# print cols
-# print rows
+    half = pixel_size * 0.5
 
-# init grid reference object
-gref = {}
-idx = 0
-for r in rows:
-    gref[str(r)] = {}
-    for c in cols:
-        # build grid reference object
-        gref[str(r)][str(c)] = idx
-        idx += 1
+    # only cells within bounds of the part of geometry in each row are tested
+    for r in range(len(rows)):
+        strip = mask_geom.intersection(box(cols[0]-half, rows[r]-half, cols[-1]+half, rows[r]+half))
+        if strip.is_empty:
+            continue
 
+        strip_prep = prep(strip)
+        (strip_minx, strip_miny, strip_maxx, strip_maxy) = strip.bounds
 
-# --------------------------------------------------
-# load project data
+        c0 = max(int((strip_minx - cols[0]) * psi) - 1, 0)
+        c1 = min(int((strip_maxx - cols[0]) * psi) + 2, len(cols))
 
-dir_data = dir_base+"/countries/"+country+"/data/"+country+"_"+str(data_version)+"/data"
+        for c in range(c0, c1):
+            if strip_prep.intersects(box(cols[c]-half, rows[r]-half, cols[c]+half, rows[r]+half)):
+                mask[r * len(cols) + c] = True
 
-merged = getData(dir_data, "project_id", (code_field, "project_location_id"), only_geocoded)
+    return mask
 
 
-# --------------------------------------------------
-# misc data prep
+# index of full grid cells in iteration rasters (see compact_cells)
+def cellIdx(cells):
+    if not compact_cells:
+        return cells
+    return cell_lookup[cells]
 
-# create copy of merged project data
-# i_m = deepcopy(merged)
 
-# get location count for each project
-merged['ones'] = (pd.Series(np.ones(len(merged)))).values
+# iteration raster from full grid raster
+def cellCompact(full):
+    if not compact_cells:
+        return full
+    return full[grid_cells]
 
-# get project location count
-grouped_location_count = merged.groupby('project_id')['ones'].sum()
 
+# full grid raster from iteration raster (cells which can not receive aid are 0)
+def cellFull(arr):
+    if not compact_cells:
+        return arr
+    full = np.zeros((int(idx+1),), dtype=arr.dtype)
+    full[grid_cells] = arr
+    return full
 
-# create new empty dataframe
-df_location_count = pd.DataFrame()
 
-# add location count series to dataframe
-df_location_count['location_count'] = grouped_location_count
+# poly grid for geometry
+# grid 1 order of magnitude higher resolution than the output grid covering geometry bounding box
+# returns arrays of poly grid x and y values
+def geomGrid(geom):
 
-# add project_id field
-df_location_count['project_id'] = df_location_count.index
+    # poly grid pixel size and poly grid pixel size inverse
+    pg_pixel_size = pixel_size * 0.1
+    pg_psi = 1/pg_pixel_size
 
-# merge location count back into data
-merged = merged.merge(df_location_count, on='project_id')
+    (pg_minx, pg_miny, pg_maxx, pg_maxy) = geom.bounds
+    (pg_minx, pg_miny, pg_maxx, pg_maxy) = (math.floor(pg_minx*pg_psi)/pg_psi, math.floor(pg_miny*pg_psi)/pg_psi, math.ceil(pg_maxx*pg_psi)/pg_psi, math.ceil(pg_maxy*pg_psi)/pg_psi)
 
-# aid field value split evenly across all project locations based on location count
-merged[aid_field].fillna(0, inplace=True)
-merged['split_dollars_pp'] = (merged[aid_field] / merged.location_count)
+    pg_cols = np.arange(pg_minx, pg_maxx+pg_pixel_size*0.5, pg_pixel_size)
+    pg_rows = np.arange(pg_maxy, pg_miny-pg_pixel_size*0.5, -1*pg_pixel_size)
 
+    return pg_cols, pg_rows
 
-# --------------------------------------------------
-# filters
 
+# number of vertices in (multi)polygon
+def geomVertices(geom):
+    if geom.geom_type == "Point":
+        return 1
 
-# filters_json = json.dumps(filters, sort_keys = True, ensure_ascii=False)
+    if hasattr(geom, "geoms"):
+        return sum(geomVertices(g) for g in geom.geoms)
+
+    return len(geom.exterior.coords) + sum(len(i.coords) for i in geom.interiors)
+
+
+# estimated cost of generating unit surface for geometry
+# poly grid points tested, scaled by log of vertex count for each point in polygon test
+# points only require a single grid lookup
+def geomCost(geom):
+    if geom.geom_type == "Point":
+        return 1.0
+
+    pg_cols, pg_rows = geomGrid(geom)
+    return len(pg_cols) * len(pg_rows) * (1 + math.log(geomVertices(geom), 2))
+
+
+# mean surface tasks for geometry
+# geometries with large poly grids are split into tiles of poly grid rows
+# returns list of (unique id, first row, last row, estimated cost) tuples
+def geomTasks(unique_id, geom):
+    cost = geomCost(geom)
+
+    if geom.geom_type == "Point":
+        return [(unique_id, 0, 1, cost)]
+
+    pg_cols, pg_rows = geomGrid(geom)
+
+    tile_rows = max(1, int(surf_tile_points // max(1, len(pg_cols))))
+    tile_count = int(math.ceil(len(pg_rows) / float(tile_rows)))
+
+    return [(unique_id, r0, min(r0+tile_rows, len(pg_rows)), cost * (min(r0+tile_rows, len(pg_rows)) - r0) / len(pg_rows))
+            for r0 in range(0, tile_count * tile_rows, tile_rows)]
+
+
+# grid coverage of geometry
+# counts the poly grid points which are within the geometry, by the output grid cell each point rounds to
+# tile_rows limits the count to a range of poly grid rows
+# returns arrays of cell indices and point counts
+def geomCoverage(geom, tile_rows=None):
+
+    if geom.geom_type == "Point":
+        return gridIdx([geom.x], [geom.y]), np.ones((1,))
+
+    pg_cols, pg_rows = geomGrid(geom)
+
+    if tile_rows is not None:
+        pg_rows = pg_rows[tile_rows[0]:tile_rows[1]]
+
+    pg_geom = prep(geom)
+
+    pg_x = []
+    pg_y = []
+    for r in pg_rows:
+        for c in pg_cols:
+            if pg_geom.contains(Point(c, r)):
+                pg_x.append(c)
+                pg_y.append(r)
+
+    if len(pg_x) == 0:
+        return np.zeros((0,), dtype=np.int64), np.zeros((0,))
+
+    cells, counts = np.unique(gridIdx(pg_x, pg_y), return_counts=True)
+
+    return cells, counts.astype(np.float64)
+
+
+# --------------------------------------------------
+
+
+# location table fields shared with all ranks
+def locFields():
+    return ['project_id', 'agg_type', code_field, 'longitude', 'latitude', 'split_dollars_pp', aid_field]
+
+
+# location table fields as numpy arrays
+def packRows(loc_df):
+    fields = {}
+    for field in locFields():
+        values = np.asarray(loc_df[field].values)
+        if values.dtype == object:
+            values = values.astype(str)
+        fields[field] = values
+
+    return fields
+
+
+# first and last (exclusive) row of shard for rank
+def shardRange(n, shard_rank, shard_count):
+    return (n * shard_rank // shard_count, n * (shard_rank + 1) // shard_count)
+
+
+# mpi datatype for numpy array
+def mpiType(arr):
+    return {
+        np.dtype(np.int32): MPI.INT32_T,
+        np.dtype(np.int64): MPI.INT64_T,
+        np.dtype(np.uint8): MPI.UNSIGNED_CHAR,
+        np.dtype(np.float64): MPI.DOUBLE
+    }[arr.dtype]
+
+
+# gather variable length array from every rank onto every rank
+# counts is the number of elements contributed by each rank
+def allgatherArray(local, counts):
+    if size == 1:
+        return local.copy()
+
+    counts = [int(c) for c in counts]
+    displs = [int(sum(counts[0:i])) for i in range(len(counts))]
+    out = np.zeros((sum(counts),), dtype=local.dtype)
+    comm.Allgatherv([local, mpiType(local)], [out, counts, displs, mpiType(local)])
+    return out
+
+
+# --------------------------------------------------
+
+
+# ====================================================================================================
+# ====================================================================================================
+
+
+# --------------------------------------------------
+# filters hash
+
+
+# filters_json = json.dumps(filters, sort_keys = True, ensure_ascii=False)
 # filters_md5 = hashlib.md5()
 # filters_md5.update(filters_json)
 # filters_hash = filters_md5.hexdigest()
@@ -525,128 +1439,1644 @@ merged['split_dollars_pp'] = (merged[aid_field] / merged.location_count)
 filters_hash = json_hash(filters)
 
 
-# apply filters to project data
-# filtered = merged.loc[merged.ad_sector_names == "Agriculture"]
-
-# !!! potential issue !!!
+# ====================================================================================================
+# ====================================================================================================
+# data prep
 #
-# - filters which remove only some locations from a project will skew aid splits
-# - moved original project location count to before filters so that it can be used to
-#   compare the count of project locations before filter to count after and generate
-#   placeholder random values for the locations that were filtered out
-# - method: recheck project location count and create placeholder random value if locations are missing
-# - will need to rebuild how random num column is added. probaby can use apply with a new function
+# shapefiles and project data are only loaded and processed by master
+# all ranks receive a compact copy of the adm shapes and location table
+# geometries are then assigned to a shard of the locations by each rank and gathered on all ranks
+
+
+# must start at and inlcude ADM0
+# all additional ADM shps must be included so that adm_path index corresponds to adm level
+adm_paths = []
+adm_paths.append(dir_base+"/countries/"+country+"/shapefiles/ADM0/"+abbr+"_adm0.shp")
+adm_paths.append(dir_base+"/countries/"+country+"/shapefiles/ADM1/"+abbr+"_adm1.shp")
+adm_paths.append(dir_base+"/countries/"+country+"/shapefiles/ADM2/"+abbr+"_adm2.shp")
+
+dir_data = dir_base+"/countries/"+country+"/data/"+country+"_"+str(data_version)+"/data"
+
+
+if rank == 0:
+
+    # --------------------------------------------------
+    # load shapefiles
+
+    # get adm0 bounding box
+    adm_shps = [[shape(shp) for shp in shapefile.Reader(adm_path).shapes()] for adm_path in adm_paths]
+
+
+    # --------------------------------------------------
+    # load project data
+
+    merged = getData(dir_data, "project_id", (code_field, "project_location_id"), only_geocoded)
+
+
+    # --------------------------------------------------
+    # misc data prep
+
+    # create copy of merged project data
+    # i_m = deepcopy(merged)
+
+    # get location count for each project
+    merged['ones'] = (pd.Series(np.ones(len(merged)))).values
+
+    # get project location count
+    grouped_location_count = merged.groupby('project_id')['ones'].sum()
+
+
+    # create new empty dataframe
+    df_location_count = pd.DataFrame()
+
+    # add location count series to dataframe
+    df_location_count['location_count'] = grouped_location_count
+
+    # add project_id field
+    df_location_count['project_id'] = df_location_count.index
+
+    # merge location count back into data
+    merged = merged.merge(df_location_count, on='project_id')
+
+    # aid field value split evenly across all project locations based on location count
+    merged[aid_field].fillna(0, inplace=True)
+    merged['split_dollars_pp'] = (merged[aid_field] / merged.location_count)
+
+
+    # --------------------------------------------------
+    # filters
+
+
+    # apply filters to project data
+    # filtered = merged.loc[merged.ad_sector_names == "Agriculture"]
+
+    # !!! potential issue !!!
+    #
+    # - filters which remove only some locations from a project will skew aid splits
+    # - moved original project location count to before filters so that it can be used to
+    #   compare the count of project locations before filter to count after and generate
+    #   placeholder random values for the locations that were filtered out
+    # - method: recheck project location count and create placeholder random value if locations are missing
+    # - will need to rebuild how random num column is added. probaby can use apply with a new function
+
+    filtered = deepcopy(merged)
+
+
+    # --------------------------------------------------
+    # assign geometry types
+
+    filtered["agg_type"] = filtered.apply(lambda x: geomType(x[is_geocoded], x[code_field]), axis=1)
+
+
+    # --------------------------------------------------
+    # pack adm shapes and location table for all ranks
+
+    packed_data = {
+        "adm": [packWkb(level) for level in adm_shps],
+        "rows": packRows(filtered)
+    }
+
+else:
+    packed_data = None
+
+
+# in node shared mode only the first rank on each node receives the data
+# and places it in shared memory for the rest of the node
+if node_shared:
+    if node_rank == 0:
+        packed_data = leader_comm.bcast(packed_data, root=0)
+
+    adm_count = node_comm.bcast(len(packed_data["adm"]) if node_rank == 0 else None, root=0)
+    packed_adm = [tuple(nodeShared(packed_data["adm"][i][j] if node_rank == 0 else None) for j in range(2)) for i in range(adm_count)]
+    loc_rows = dict((f, nodeShared(packed_data["rows"][f] if node_rank == 0 else None)) for f in locFields())
+
+else:
+    packed_data = comm.bcast(packed_data, root=0)
+
+    packed_adm = packed_data["adm"]
+    loc_rows = packed_data["rows"]
+
+del packed_data
+
+adm_shps = [[unpackWkb(buf, offsets, i) for i in range(len(offsets) - 1)] for (buf, offsets) in packed_adm]
+
+del packed_adm
+
+# define country shape
+adm0 = adm_shps[0][0]
+
+
+# --------------------------------------------------
+# create point grid for country
+
+# country bounding box
+(adm0_minx, adm0_miny, adm0_maxx, adm0_maxy) = adm0.bounds
+# print( (adm0_minx, adm0_miny, adm0_maxx, adm0_maxy) )
+
+# grid_buffer
+gb = 0.5
+
+# bounding box rounded to pixel size (always increases bounding box size, never decreases)
+(adm0_minx, adm0_miny, adm0_maxx, adm0_maxy) = (math.floor(adm0_minx*gb)/gb, math.floor(adm0_miny*gb)/gb, math.ceil(adm0_maxx*gb)/gb, math.ceil(adm0_maxy*gb)/gb)
+# print( (adm0_minx, adm0_miny, adm0_maxx, adm0_maxy) )
 
-filtered = deepcopy(merged)
+# generate arrays of new grid x and y values
+cols = np.arange(adm0_minx, adm0_maxx+pixel_size*0.5, pixel_size)
+rows = np.arange(adm0_maxy, adm0_miny-pixel_size*0.5, -1*pixel_size)
+
+# print cols
+# print rows
+
+# number of grid cells
+# cell indices are calculated from coordinates (see gridIdx)
+idx = len(rows) * len(cols)
 
 
 # --------------------------------------------------
 # assign geometries
 
-# add geom columns
-filtered["agg_type"] = ["None"] * len(filtered)
-filtered["agg_geom"] = ["None"] * len(filtered)
+# each rank assigns geometries for its shard of the location rows
+loc_count = len(loc_rows["agg_type"])
+shard_counts = [shardRange(loc_count, i, size)[1] - shardRange(loc_count, i, size)[0] for i in range(size)]
+
+(shard_level, shard_item, shard_cell, shard_length, shard_wkb) = geomShard(loc_rows, *shardRange(loc_count, rank, size))
+
+# combine shards on all ranks
+geom_level = allgatherArray(shard_level, shard_counts)
+geom_item = allgatherArray(shard_item, shard_counts)
+geom_cell = allgatherArray(shard_cell, shard_counts)
+geom_length = allgatherArray(shard_length, shard_counts)
+
+wkb_counts = [np.sum(geom_length[shardRange(loc_count, i, size)[0]:shardRange(loc_count, i, size)[1]]) for i in range(size)]
+geom_wkb = allgatherArray(shard_wkb, wkb_counts)
+geom_offset = np.concatenate(([0], np.cumsum(geom_length))).astype(np.int64)
+
+# combined references are identical on every rank, only one copy per node is kept in node shared mode
+geom_level = nodeShared(geom_level)
+geom_item = nodeShared(geom_item)
+geom_cell = nodeShared(geom_cell)
+geom_wkb = nodeShared(geom_wkb)
+geom_offset = nodeShared(geom_offset)
+
+# rows without a geometry are dropped
+# in node shared mode kept rows are selected once per node so location columns stay views of shared memory
+loc_index = np.flatnonzero(geom_level != geom_none)
+
+geom_start = geom_offset[:-1]
+geom_end = geom_offset[1:]
+
+if len(loc_index) < loc_count:
+    loc_rows = dict((f, nodeTake(loc_rows[f], loc_index)) for f in locFields())
+    geom_level = nodeTake(geom_level, loc_index)
+    geom_item = nodeTake(geom_item, loc_index)
+    geom_cell = nodeTake(geom_cell, loc_index)
+    geom_start = nodeTake(geom_start, loc_index)
+    geom_end = nodeTake(geom_end, loc_index)
+
+del loc_index
+
+# numeric columns are not copied (string columns are converted by pandas)
+# geometries are not kept in the table, see locGeom
+loc_rows["cell"] = geom_cell
+i_m = pd.DataFrame(loc_rows, columns=locFields() + ["cell"], copy=False)
+
+del loc_rows
+
+
+i_m['unique'] = range(0, len(i_m))
+
+# rows sharing a geometry share its unit surface
+# keys of adm shapes are only computed once, keys of buffers are computed from their wkb
+adm_keys = {}
+geom_keys = []
+for i in range(len(i_m)):
+    if geom_level[i] >= 0:
+        if (geom_level[i], geom_item[i]) not in adm_keys:
+            adm_keys[(geom_level[i], geom_item[i])] = geomKey(locGeom(i))
+        geom_keys.append(adm_keys[(geom_level[i], geom_item[i])])
+    elif geom_level[i] == geom_buffer:
+        geom_keys.append(hashlib.md5(geom_wkb[geom_start[i]:geom_end[i]]).hexdigest())
+    else:
+        geom_keys.append(None)
+
+i_m['geom_key'] = geom_keys
+
+# adm shapes not referenced by a location are no longer needed
+adm_shps = [[tmp_shp if (l, k) in adm_keys else None for (k, tmp_shp) in enumerate(tmp_level)] for (l, tmp_level) in enumerate(adm_shps)]
+
+del adm_keys, geom_keys
+
+
+# --------------------------------------------------
+# compact cells
+
+# iteration rasters and statistics have grid_size cells
+# in compact mode only cells which can receive aid are used, mapped back to full grid for outputs
+# cells are found by master and sent to all ranks (node shared when enabled)
+
+if compact_cells:
+
+    if rank == 0:
+        tmp_polys = i_m.loc[i_m.agg_type != "point"].drop_duplicates('geom_key')
+        grid_cells = np.flatnonzero(gridMask([locGeom(i) for i in tmp_polys.unique], i_m.loc[i_m.agg_type == "point"].cell.values)).astype(np.int64)
+        del tmp_polys
+    else:
+        grid_cells = None
+
+    if node_shared:
+        if node_rank == 0:
+            grid_cells = leader_comm.bcast(grid_cells, root=0)
+
+        grid_cells = nodeShared(grid_cells if node_rank == 0 else None)
+
+    else:
+        grid_cells = comm.bcast(grid_cells, root=0)
+
+    cell_lookup = np.zeros((int(idx+1),), dtype=np.int64) - 1
+    cell_lookup[grid_cells] = np.arange(len(grid_cells))
+    cell_lookup = nodeShared(cell_lookup)
+
+    grid_size = len(grid_cells)
+
+else:
+    grid_size = int(idx+1)
+
+
+# --------------------------------------------------
+# iteration tiles
+
+# in tiled mode the grid is split into row bands, each owned by a tile rank (last iter_tiles ranks)
+# workers send each tile rank the cells of its band and tile ranks keep statistics for their band
+# bands have about the same number of iteration cells
+# tile_bounds are iteration raster (compact) indices, tile_full are full grid indices
+
+if iter_tiles > 0:
+
+    if iter_tiles > len(rows):
+        sys.exit("iter_tiles is more than number of grid rows: "+str(len(rows)))
+
+    tile_ranks = list(range(size - iter_tiles, size))
+
+    # last full grid index is past the last row
+    if compact_cells:
+        tmp_row_cells = np.bincount(grid_cells // len(cols), minlength=len(rows)+1)
+    else:
+        tmp_row_cells = np.array([len(cols)] * len(rows) + [1])
+
+    tmp_cum = np.cumsum(tmp_row_cells)
+
+    tile_rows = [0]
+    for t in range(1, iter_tiles):
+        tmp_row = int(np.searchsorted(tmp_cum, tmp_cum[-1] * t / float(iter_tiles))) + 1
+        tile_rows.append(min(max(tmp_row, tile_rows[-1] + 1), len(rows) - iter_tiles + t))
+    tile_rows.append(len(rows))
+
+    tile_full = np.array([r * len(cols) for r in tile_rows[:-1]] + [int(idx+1)], dtype=np.int64)
+
+    if compact_cells:
+        tile_bounds = np.searchsorted(grid_cells, tile_full).astype(np.int64)
+    else:
+        tile_bounds = tile_full
+
+    del tmp_row_cells, tmp_cum
+
+else:
+    tile_ranks = []
+
+
+# --------------------------------------------------
+# iteration inputs
+
+# locations ordered by project so random splits of each project's aid
+# can be normalized with segmented sums (see randomSplits)
+split_order = np.argsort(i_m.project_id.values, kind='mergesort')
+
+tmp_project = i_m.project_id.values[split_order]
+tmp_first = np.concatenate(([True], tmp_project[1:] != tmp_project[:-1]))
+
+# start of each project and project of each location
+split_starts = np.flatnonzero(tmp_first)
+split_group = np.cumsum(tmp_first) - 1
+
+# numeric inputs are node shared like the location columns they are ordered from
+split_aid = nodeShared(i_m[aid_field].values[split_order].astype(np.float64))
+split_type = i_m.agg_type.values[split_order]
+split_key = i_m.geom_key.values[split_order]
+split_cell = nodeShared(cellIdx(i_m.cell.values[split_order].astype(np.int64)))
+
+# polygon geometries are only unpacked on ranks which sample points within them each iteration
+if iter_sampling == "alias":
+    split_geom = None
+else:
+    split_geom = [locGeom(i) for i in split_order]
+
+# point locations never move, only polygon locations are placed each iteration
+split_points = np.flatnonzero(split_type == "point")
+split_polys = np.flatnonzero(split_type != "point")
+
+del tmp_project, tmp_first
+
+
+# ====================================================================================================
+# ====================================================================================================
+# master init
+
+
+if rank == 0:
+
+    # --------------------------------------------------
+    # initialize results file output
+
+    results_str = "Monte Carlo Rasterization Output File\t "
+
+    results_str += "\nstart time\t" + str(Ts)
+    results_str += "\ncountry\t" + str(country)
+    results_str += "\nabbr\t" + str(abbr)
+    results_str += "\npixel_size\t" + str(pixel_size)
+    results_str += "\niter_max\t" + str(iter_max)
+    results_str += "\nnodata\t" + str(nodata)
+    results_str += "\naid_field\t" + str(aid_field)
+    results_str += "\ncode_field\t" + str(code_field)
+    results_str += "\ncountry bounds\t" + str((adm0_minx, adm0_miny, adm0_maxx, adm0_maxy))
+
+    results_str += "\nrows\t" + str(len(rows))
+    results_str += "\ncolumns\t" + str(len(cols))
+    results_str += "\ngrid cells\t" + str(grid_size)
+    results_str += "\nlocations\t" + str(len(i_m))
+    results_str += "\nbackend\t" + str(backend)
+    results_str += "\nworkers\t" + str(task_workers)
+    results_str += "\niter tiles\t" + str(iter_tiles)
+    results_str += "\nsub-masters\t" + str(len(group_ranks))
+    results_str += "\ntask prefetch\t" + str(task_prefetch)
+    results_str += "\ntask speculate\t" + str(task_speculate)
+
+    # results_str += "\nfilters\t" + str(filters)
+
+
+    # --------------------------------------------------
+    # mean surface cache key
+
+    # data files, shapefiles and options which determine the mean surface
+    adm_files = [path[:-4]+ext for path in adm_paths for ext in (".shp", ".shx") if os.path.isfile(path[:-4]+ext)]
+
+    surf_inputs = {
+        "version": surf_cache_version,
+        "data": [file_hash(dir_data+"/projects.tsv"), file_hash(dir_data+"/locations.tsv")],
+        "shapefiles": [file_hash(path) for path in adm_files],
+        "lookup": lookup,
+        "filters": filters,
+        "pixel_size": pixel_size,
+        "aid_field": aid_field,
+        "is_geocoded": is_geocoded,
+        "code_field": code_field,
+        "only_geocoded": only_geocoded,
+        "not_geocoded": not_geocoded
+    }
+
+    surf_hash = json_hash(surf_inputs)
+
+    results_str += "\nsurf hash\t" + str(surf_hash)
+
+
+    # --------------------------------------------------
+    # initialize asc file output
+
+    asc = ""
+    asc += "NCOLS " + str(len(cols)) + "\n"
+    asc += "NROWS " + str(len(rows)) + "\n"
+
+    # asc += "XLLCORNER " + str(adm0_minx-pixel_size*0.5) + "\n"
+    # asc += "YLLCORNER " + str(adm0_miny-pixel_size*0.5) + "\n"
+
+    asc += "XLLCENTER " + str(adm0_minx) + "\n"
+    asc += "YLLCENTER " + str(adm0_miny) + "\n"
+
+    asc += "CELLSIZE " + str(pixel_size) + "\n"
+    asc += "NODATA_VALUE " + str(nodata) + "\n"
+
+
+    # --------------------------------------------------
+    # build output directories
+
+    make_dir(dir_working)
+
+
+    # --------------------------------------------------
+    # record init runtime
+
+    time_init = time.time()
+    T_init = int(time_init - Ts)
+
+    results_str += "\nInit Runtime\t" + str(T_init//60) +'m '+ str(int(T_init%60)) +'s'
+    print('\tInit Runtime: ' + str(T_init//60) +'m '+ str(int(T_init%60)) +'s')
+
+
+# ====================================================================================================
+# ====================================================================================================
+
+comm.Barrier()
+# sys.exit("! - init only")
+
+# ====================================================================================================
+# ====================================================================================================
+# mpi prep
+
+
+# terminate if master init fails
+#
+
+# Define MPI message tags
+# LOST is not sent, master uses it for workers which timed out
+# ALIVE is sent by sub-masters between batch results so master does not time them out
+# INIT is sent by master to ranks taking part in iterations once mean surface is done
+tags = enum('READY', 'DONE', 'EXIT', 'START', 'ERROR', 'SURF', 'SURF_DONE', 'TILE', 'CHECK', 'FINISH', 'LOST', 'ALIVE', 'INIT')
+
+
+# init for later
+sum_mean_surf = 0
+surf_ready = 0
+surf_tasks = []
+all_unit_surf = []
+
+# check if mean surf exists in cache
+run_mean_surf = 1
+
+if rank == 0 and not force_mean_surf:
+    cache_mean_surf = surfCacheLoad(surf_hash, int(idx+1))
+
+    # alias sampling also needs unit surfaces of every polygon geometry, which are generated with mean surf
+    if cache_mean_surf is not None and iter_sampling == "alias":
+        if not set(i_m.loc[i_m.agg_type != "point"].geom_key).issubset(unitCacheLoad()["keys"]):
+            cache_mean_surf = None
+
+    if cache_mean_surf is not None:
+        sum_mean_surf = cache_mean_surf
+        run_mean_surf = 0
+
+run_mean_surf = comm.bcast(run_mean_surf, root=0)
+
+# mean surface and iteration phases only overlap when a mean surface needs to be generated
+# (surf_pipeline is checked against iter_sampling and iter_tiles with the other options)
+surf_pipelined = surf_pipeline == 1 and run_mean_surf == 1 and mean_surf_only == 0
+
+
+# --------------------------------------------------
+# worker tasks
+
+
+# unit surface of a mean surface task (geometry tile)
+def surfWork(task):
+    pg_data = i_m.loc[task[0]]
+
+    # unit surface of task geometry tile as grid cell indices and point counts
+    pg_cells, pg_counts = geomCoverage(locGeom(task[0]), task[1:3])
+
+    return (pg_data.geom_key, pg_cells, pg_counts)
+
+
+# random stream of an iteration
+# counter based generator keyed by run seed with iteration as high word of counter
+# so each iteration has its own stream regardless of which worker runs it
+def iterRng(seed, iteration):
+    return np.random.Generator(np.random.Philox(key=seed, counter=[0, 0, 0, iteration]))
+
+
+# alias table (Walker's method) for sampling from discrete weights
+# returns probability of keeping each entry and entry used otherwise
+def aliasTable(weights):
+    n = len(weights)
+    prob = np.asarray(weights, dtype=np.float64) * n / np.sum(weights)
+    alias = np.arange(n)
+
+    small = [i for i in range(n) if prob[i] < 1.0]
+    large = [i for i in range(n) if prob[i] >= 1.0]
+
+    while len(small) > 0 and len(large) > 0:
+        s = small.pop()
+        l = large.pop()
+
+        alias[s] = l
+        prob[l] = prob[l] + prob[s] - 1.0
+
+        if prob[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+
+    # leftovers are only off from 1 by rounding error
+    for i in small + large:
+        prob[i] = 1.0
+
+    return prob, alias
+
+
+# alias tables for grid cells of every polygon geometry used by locations
+# built from unit surface (coverage weights) rows, geometries too small to cover a poly grid point use cell of a point within them
+# returns flat arrays of all tables (alias entries are absolute positions) and table of each location in project order (-1 for points)
+def aliasTables(unit):
+    unit_rows = dict((k, i) for (i, k) in enumerate(unit["keys"]))
+
+    table_index = {}
+    table_geoms = []
+    loc_table = np.zeros((len(split_order),), dtype=np.int64) - 1
+
+    for j in range(len(split_order)):
+        if split_type[j] != "point":
+            if split_key[j] not in table_index:
+                table_index[split_key[j]] = len(table_index)
+                table_geoms.append((split_key[j], locGeom(split_order[j])))
+            loc_table[j] = table_index[split_key[j]]
+
+    offset = [0]
+    cells = []
+    weights = []
+    prob = []
+    alias = []
+
+    for (tmp_key, tmp_geom) in table_geoms:
+        r = unit_rows[tmp_key]
+        tmp_cells = unit["cells"][unit["indptr"][r]:unit["indptr"][r+1]]
+        tmp_weights = unit["weights"][unit["indptr"][r]:unit["indptr"][r+1]]
+
+        if len(tmp_cells) == 0:
+            tmp_pt = tmp_geom.representative_point()
+            tmp_cells = gridIdx([tmp_pt.x], [tmp_pt.y])
+            tmp_weights = np.ones((1,))
+
+        tmp_cells = cellIdx(tmp_cells)
+
+        (tmp_prob, tmp_alias) = aliasTable(tmp_weights)
+
+        cells.append(tmp_cells)
+        weights.append(tmp_weights / np.sum(tmp_weights))
+        prob.append(tmp_prob)
+        alias.append(tmp_alias + offset[-1])
+        offset.append(offset[-1] + len(tmp_cells))
+
+    if len(table_geoms) == 0:
+        cells = weights = prob = alias = [np.zeros((0,))]
+
+    return {
+        "offset": np.array(offset, dtype=np.int64),
+        "cells": np.concatenate(cells).astype(np.int64),
+        "weights": np.concatenate(weights).astype(np.float64),
+        "prob": np.concatenate(prob).astype(np.float64),
+        "alias": np.concatenate(alias).astype(np.int64),
+        "loc_table": loc_table
+    }
+
+
+# grid cell of every polygon location (see split_polys) for an iteration using alias tables
+# locations sharing a geometry with many others are drawn as a group: cell counts from a single
+# multinomial draw are given to the group's locations in random order, which has the same
+# distribution as drawing each location's cell separately
+def aliasCells(rng):
+    start = alias_data["offset"][alias_single_tables]
+    count = alias_data["offset"][alias_single_tables+1] - start
+
+    j = start + (rng.random(len(alias_single)) * count).astype(np.int64)
+    pick = np.where(rng.random(len(alias_single)) < alias_data["prob"][j], j, alias_data["alias"][j])
+
+    rnd_cell = np.zeros((len(split_polys),), dtype=np.int64)
+    rnd_cell[alias_single] = alias_data["cells"][pick]
+
+    for (tmp_table, tmp_locs) in alias_groups:
+        a = alias_data["offset"][tmp_table]
+        b = alias_data["offset"][tmp_table+1]
+
+        tmp_counts = rng.multinomial(len(tmp_locs), alias_data["weights"][a:b])
+        rnd_cell[tmp_locs] = rng.permutation(np.repeat(alias_data["cells"][a:b], tmp_counts))
+
+    return rnd_cell
+
+
+# grid cell of every polygon location (see split_polys) for an iteration
+def polyCells(rng):
+    if iter_sampling == "alias":
+        return aliasCells(rng)
+
+    rnd_pt = [addPt(split_type[j], split_geom[j], rng) for j in split_polys]
+    return cellIdx(gridIdx([pt.x for pt in rnd_pt], [pt.y for pt in rnd_pt]))
+
+
+# random dollars of every location for a batch of iterations (one rng per iteration)
+# draws a (batch x locations) matrix of random numbers with locations in project order
+# and normalizes each row within projects using segmented sums along the location axis
+def randomSplits(rngs):
+    splits = np.empty((len(rngs), len(split_order)), dtype=np.float64)
+    for b in range(len(rngs)):
+        rngs[b].random(out=splits[b])
+
+    project_sums = np.add.reduceat(splits, split_starts, axis=1)
+
+    for b in range(len(rngs)):
+        splits[b] *= split_aid / project_sums[b][split_group]
+
+    return splits
+
+
+# aid and count rasters for a batch of iterations
+# tasks are (iteration, run seed)
+def iterBatch(tasks):
+    rngs = [iterRng(task[1], task[0]) for task in tasks]
+
+    splits = randomSplits(rngs)
+
+    # legacy accumulation only adds whole dollars of each location
+    if iter_dtype == "int64":
+        np.trunc(splits, out=splits)
+
+    # point locations are in the same cell every iteration so only their dollars change
+    # contributions for all iterations in batch are added with a single bincount
+    point_dollars = splits[:, split_points]
+    point_valid = point_dollars > 0
+    point_index = (np.arange(len(tasks))[:, None] * grid_size + split_cell[split_points][None, :])[point_valid]
+
+    point_aid = np.bincount(point_index, weights=point_dollars[point_valid], minlength=len(tasks)*grid_size).reshape((len(tasks), grid_size))
+    point_count = np.bincount(point_index, minlength=len(tasks)*grid_size).reshape((len(tasks), grid_size))
+
+    results = []
+    for b in range(len(tasks)):
+
+        poly_cell = polyCells(rngs[b])
+
+        poly_dollars = splits[b][split_polys]
+        valid = poly_dollars > 0
+
+        npa_aid = point_aid[b] + np.bincount(poly_cell[valid], weights=poly_dollars[valid], minlength=grid_size)
+        npa_count = point_count[b] + np.bincount(poly_cell[valid], minlength=grid_size)
+
+        results.append(np.array([npa_aid,npa_count]).astype(iter_dtype))
+
+    return results
+
+
+# aid and count of cells hit in each tile for a batch of iterations (tiled mode)
+# returns (iteration, tile results) for every iteration
+# tile results are (cells relative to start of tile, aid and count of cells) for every tile
+def iterTileBatch(tasks):
+    rngs = [iterRng(task[1], task[0]) for task in tasks]
+
+    splits = randomSplits(rngs)
+
+    if iter_dtype == "int64":
+        np.trunc(splits, out=splits)
+
+    point_cells = split_cell[split_points]
+
+    results = []
+    for b in range(len(tasks)):
+        poly_cell = polyCells(rngs[b])
+
+        point_dollars = splits[b][split_points]
+        poly_dollars = splits[b][split_polys]
+        point_valid = point_dollars > 0
+        valid = poly_dollars > 0
+
+        # point and polygon dollars are summed separately and then added, as in iterBatch,
+        # so tile results are identical to the same cells of full rasters
+        hit_cells = np.unique(np.concatenate((point_cells[point_valid], poly_cell[valid])))
+        point_index = np.searchsorted(hit_cells, point_cells[point_valid])
+        poly_index = np.searchsorted(hit_cells, poly_cell[valid])
+
+        hit_aid = np.bincount(point_index, weights=point_dollars[point_valid], minlength=len(hit_cells)) + np.bincount(poly_index, weights=poly_dollars[valid], minlength=len(hit_cells))
+        hit_count = np.bincount(point_index, minlength=len(hit_cells)) + np.bincount(poly_index, minlength=len(hit_cells))
+        hit_result = np.array([hit_aid, hit_count]).astype(iter_dtype)
+
+        hit_bounds = np.searchsorted(hit_cells, tile_bounds)
+
+        results.append((tasks[b][0], [(hit_cells[hit_bounds[t]:hit_bounds[t+1]] - tile_bounds[t], hit_result[:, hit_bounds[t]:hit_bounds[t+1]]) for t in range(iter_tiles)]))
+
+    return results
+
+
+# aid and count rasters for a single iteration
+def iterWork(task):
+    return iterBatch([task])[0]
+
+
+# iteration result sent to master, which folds results in iteration order
+def iterResult(task):
+    return (task[0], iterWork(task))
+
+
+# iteration results for a batch of iterations
+def iterBatchResult(tasks):
+    return [(task[0], result) for (task, result) in zip(tasks, iterBatch(tasks))]
+
+
+# local pool used by hybrid and local backends
+# created on first use so pool processes inherit prepared data
+worker_pool = None
+
+def poolCount():
+    return pool_size if pool_size > 0 else multiprocessing.cpu_count()
+
+# close pool, next use creates (forks) it again with current data
+def poolReset():
+    global worker_pool
+    if worker_pool is not None:
+        worker_pool.close()
+        worker_pool.join()
+        worker_pool = None
+
+def workerPool():
+    global worker_pool
+    if worker_pool is None:
+        tmp_size = poolCount()
+        if pool_type == "thread":
+            worker_pool = ThreadPool(tmp_size)
+        else:
+            worker_pool = multiprocessing.Pool(tmp_size)
+    return worker_pool
+
+
+# batch of mean surface tasks on local pool
+def surfPool(tasks):
+    return workerPool().map(surfWork, tasks)
+
+
+# batch of iterations on local pool
+# each pool process runs a contiguous chunk of the batch
+def iterPool(tasks):
+    chunk_size = int(math.ceil(len(tasks) / float(poolCount())))
+    chunks = [tasks[i:i+chunk_size] for i in range(0, len(tasks), chunk_size)]
+    return [r for chunk in workerPool().map(iterTileBatch if iter_tiles > 0 else iterBatchResult, chunks) for r in chunk]
+
+
+# statistics of a block of iterations (see iterBlockEnd) on local pool
+# results are folded on the node in iteration order so master is sent a single raster set per block
+# returns (first iteration of block, statistics)
+def iterPoolStats(tasks):
+    batch_stats = statsNew(grid_size)
+    for (tmp_iteration, tmp_result) in iterPool(tasks):
+        statsAdd(batch_stats, tmp_result)
+    return tasks[0][0], batch_stats
+
+
+# send tile results of iterations to tile ranks
+# master is only sent the number of iterations done (as statistics without cells) to track progress
+def tileSend(results):
+    for t in range(iter_tiles):
+        comm.send([(i, parts[t]) for (i, parts) in results], dest=tile_ranks[t], tag=tags.TILE)
+
+    tmp_done = statsNew(0)
+    tmp_done["n"] = len(results)
+    comm.send((results[0][0], tmp_done), dest=0, tag=tags.DONE)
+
+
+# worker loop
+# requests tasks from master (or sub-master of group) until told to exit
+# handles both mean surface and iteration tasks
+# tasks are batches run on a local pool for hybrid backend
+# with task_prefetch iteration workers only send ready once and receive
+# their next task while running the current one (see taskRecv)
+# a task which fails is reported to master (with its traceback) and the worker carries on
+def workerLoop(label, master=0):
+    name = MPI.Get_processor_name()
+    print("%s Worker - rank %d on %s." % (label, rank, name))
+
+    prefetch = task_prefetch > 0 and label == "Iter"
+    if prefetch:
+        comm.send(None, dest=master, tag=tags.READY)
+        task_req = comm.irecv(source=master, tag=MPI.ANY_TAG)
+
+    while True:
+        if prefetch:
+            task = task_req.wait(status=status)
+            tag = status.Get_tag()
+            if tag in [tags.START, tags.SURF]:
+                task_req = comm.irecv(source=master, tag=MPI.ANY_TAG)
+
+        else:
+            comm.send(None, dest=master, tag=tags.READY)
+            task = comm.recv(source=master, tag=MPI.ANY_TAG, status=status)
+            tag = status.Get_tag()
+
+        try:
+            if tag == tags.SURF and backend == "hybrid":
+                comm.send(surfPool(task), dest=master, tag=tags.SURF_DONE)
+
+            elif tag == tags.SURF:
+                comm.send(surfWork(task), dest=master, tag=tags.SURF_DONE)
+
+            elif tag == tags.START and iter_tiles > 0:
+                tileSend(iterPool(task) if backend == "hybrid" else iterTileBatch([task]))
+
+            elif tag == tags.START and backend == "hybrid":
+                comm.send(iterPoolStats(task), dest=master, tag=tags.DONE)
+
+            elif tag == tags.START:
+                comm.send(iterResult(task), dest=master, tag=tags.DONE)
+
+        except Exception:
+            print("%s Worker - task failed on rank %d." % (label, rank))
+            comm.send((task, traceback.format_exc()), dest=master, tag=tags.ERROR)
+            continue
+
+        if tag == tags.EXIT:
+            comm.send(None, dest=master, tag=tags.EXIT)
+            break
+
+        elif tag == tags.ERROR:
+            print("%s Worker - error message from master. Shutting down." % label)
+            # confirm error message received and exit
+            comm.send(None, dest=master, tag=tags.EXIT)
+            break
+
+    # tile ranks have every result from worker once it exits
+    if label == "Iter":
+        for tmp_rank in tile_ranks:
+            comm.send(None, dest=tmp_rank, tag=tags.EXIT)
+
+
+# --------------------------------------------------
+# sub-masters
+
+
+# sub-master loop
+# requests batches of iterations from master and hands their tasks to the workers of its group
+# results of each batch are folded in iteration order and sent to master as statistics of the batch
+# the next batch is requested as soon as every task of the current batch has been handed out
+# and after sending results of a batch, since master checks error values when asked for work
+# exit and error messages from master are passed on to workers once tasks already received are done
+# (tasks are dropped on error)
+# failed tasks are run again and workers are quarantined after task_failures_max failures,
+# tasks of workers not heard from in task_timeout seconds are run again by other workers,
+# counts of failures and lost workers are sent to master on exit
+# with task_timeout sub-master polls for messages and sends master a heartbeat (ALIVE)
+# at a quarter of task_timeout, since results of a batch may take longer than task_timeout
+def groupLoop(workers):
+    name = MPI.Get_processor_name()
+    print("Sub-master - rank %d on %s with %d workers." % (rank, name, len(workers)))
+
+    group_tasks = []
+    group_ready = []
+    group_batches = {}
+    group_pending = {}
+    group_exit = None
+    group_sent = 0
+    group_failures = dict((w, 0) for w in workers)
+    group_reassigned = 0
+    group_quarantine = []
+    group_running = {}
+    group_heard = {}
+    group_lost = []
+    group_alive = time.time()
+    requested = 0
+    closed = 0
+
+    while closed < len(workers):
+
+        # nothing more is asked of master once it sent exit (or error)
+        if not requested and group_exit is None and (len(group_tasks) == 0 or group_sent):
+            comm.send(None, dest=0, tag=tags.READY)
+            requested = 1
+            group_sent = 0
+
+        if task_timeout == 0:
+            data = comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+            source = status.Get_source()
+            tag = status.Get_tag()
+
+        while task_timeout > 0:
+            msg = comm.improbe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+            if msg is not None:
+                data = msg.recv()
+                source = status.Get_source()
+                tag = status.Get_tag()
+                group_heard[source] = time.time()
+                break
+
+            tmp_time = time.time()
+            if tmp_time - group_alive > task_timeout / 4.0:
+                comm.send(None, dest=0, tag=tags.ALIVE)
+                group_alive = tmp_time
+
+            tmp_lost = [w for (w, r) in group_running.items() if tmp_time - max(group_heard.get(w, 0), r[1]) > task_timeout]
+            if len(tmp_lost) > 0:
+                (data, source, tag) = (None, tmp_lost[0], tags.LOST)
+                break
+
+            time.sleep(task_poll)
+
+        if source in group_lost:
+            # tasks of lost workers were given to other workers
+            pass
+
+        elif source == 0 and tag == tags.START:
+            # statistics and last iteration of batch by first iteration of batch
+            group_batches[data[0][0]] = [statsNew(grid_size), data[-1][0]]
+            group_tasks.extend(data)
+            requested = 0
+
+        elif source == 0:
+            group_exit = tag
+            requested = 0
+            if tag == tags.ERROR:
+                group_tasks = []
+
+        elif tag == tags.READY and source not in group_quarantine:
+            group_ready.append(source)
+
+        elif tag == tags.DONE:
+            group_pending[data[0]] = data[1]
+            group_running.pop(source, None)
+
+        elif tag == tags.ERROR:
+            print("Sub-master - task failed on worker %d." % source)
+            print(data[1])
+            group_running.pop(source, None)
+            group_tasks.insert(0, data[0])
+            group_reassigned += 1
+            group_failures[source] += 1
+
+            if group_failures[source] >= task_failures_max and source not in group_quarantine:
+                print("Sub-master - quarantining worker %d." % source)
+                group_quarantine.append(source)
+                comm.send(None, dest=source, tag=tags.EXIT)
+
+        elif tag == tags.EXIT:
+            closed += 1
+
+        elif tag == tags.LOST:
+            print("Sub-master - no message from worker %d in %d seconds." % (source, task_timeout))
+            group_tasks.insert(0, group_running.pop(source)[0])
+            group_reassigned += 1
+            group_lost.append(source)
+            closed += 1
+
+        for (tmp_start, tmp_batch) in list(group_batches.items()):
+            while tmp_start + tmp_batch[0]["n"] in group_pending:
+                statsAdd(tmp_batch[0], group_pending.pop(tmp_start + tmp_batch[0]["n"]))
+
+            if tmp_start + tmp_batch[0]["n"] > tmp_batch[1]:
+                comm.send((tmp_start, tmp_batch[0]), dest=0, tag=tags.DONE)
+                del group_batches[tmp_start]
+                group_sent = 1
+
+        while len(group_ready) > 0 and len(group_tasks) > 0:
+            tmp_worker = group_ready.pop(0)
+            group_running[tmp_worker] = (group_tasks.pop(0), time.time())
+            comm.send(group_running[tmp_worker][0], dest=tmp_worker, tag=tags.START)
+
+        while len(group_ready) > 0 and group_exit is not None:
+            comm.send(None, dest=group_ready.pop(0), tag=group_exit)
+
+    comm.send((sum(group_failures.values()), group_reassigned, len(group_quarantine), len(group_lost)), dest=0, tag=tags.EXIT)
+
+
+# --------------------------------------------------
+# tile ranks
+
+
+# aid and count (or error) of tile band for full grid rows
+def tileFull(t, arr):
+    full = np.zeros((tile_full[t+1] - tile_full[t],), dtype=arr.dtype)
+    if compact_cells:
+        full[grid_cells[tile_bounds[t]:tile_bounds[t+1]] - tile_full[t]] = arr
+    else:
+        full[:] = arr
+    return full
+
+
+# path of part of asc output written by tile rank
+def tilePartPath(name, t):
+    return dir_working+"/"+name+".asc.tile"+str(t)
+
+
+# asc outputs written in parts by tile ranks
+tile_outputs = ["mean_aid", "std_aid", "var_aid", "mean_count", "std_count", "var_count", "error_surf"]
+
+
+# tile rank loop
+# folds results sent by workers into statistics of tile in iteration order
+# holds at each iter_interval until master checks error value there (CHECK)
+# and decides to continue (START), since run may stop at any check
+# once master sends final iteration count (FINISH) and every worker has exited,
+# writes its part of outputs and returns sums used for error values to master
+def tileLoop():
+    t = tile_ranks.index(rank)
+    name = MPI.Get_processor_name()
+    print("Tile - rank %d on %s, grid cells %d to %d." % (rank, name, tile_bounds[t], tile_bounds[t+1]))
+
+    tile_stats = statsNew(int(tile_bounds[t+1] - tile_bounds[t]))
+    tile_block = statsNew(int(tile_bounds[t+1] - tile_bounds[t]))
+    tile_pending = {}
+
+    # mean surface of tile band
+    tile_surf = comm.recv(source=0, tag=tags.TILE)
+
+    tile_check = 0
+    tile_check_due = 0
+    tile_finish = None
+    tile_done = 0
+    exited = 0
+
+    while exited < task_workers or not tile_done:
+        data = comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+        tag = status.Get_tag()
+
+        if tag == tags.TILE:
+            # parts of iterations already folded come from copies of straggling tasks (task_speculate)
+            for (tmp_iteration, tmp_part) in data:
+                if tmp_iteration >= tile_stats["n"] + tile_block["n"]:
+                    tile_pending[tmp_iteration] = tmp_part
+
+        elif tag == tags.CHECK:
+            tile_check_due = 1
+
+        elif tag == tags.START:
+            tile_check += 1
+
+        elif tag == tags.FINISH:
+            tile_finish = data
+            tile_done = 1
+
+        elif tag == tags.EXIT:
+            exited += 1
+
+        while True:
+            tmp_hold = iter_interval[tile_check] if tile_check < len(iter_interval) else float("inf")
+            if tile_finish is not None:
+                tmp_hold = min(tmp_hold, tile_finish)
+
+            # iterations are folded in blocks like untiled statistics (see iterBlockEnd)
+            while tile_stats["n"] + tile_block["n"] in tile_pending and tile_stats["n"] + tile_block["n"] < tmp_hold:
+                (tmp_cells, tmp_result) = tile_pending.pop(tile_stats["n"] + tile_block["n"])
+                statsAddCells(tile_block, tmp_cells, tmp_result)
+                if tile_stats["n"] + tile_block["n"] == iterBlockEnd(tile_stats["n"]):
+                    statsMerge(tile_stats, tile_block)
+                    tile_block = statsNew(int(tile_bounds[t+1] - tile_bounds[t]))
+
+            if tile_check_due and tile_check < len(iter_interval) and tile_stats["n"] == iter_interval[tile_check]:
+                tmp_mean_aid = tile_stats["aid_sum"] / tile_stats["n"]
+                comm.send((np.sum(tmp_mean_aid), np.sum(np.absolute(tile_surf - tmp_mean_aid))), dest=0, tag=tags.CHECK)
+                tile_check_due = 0
+            else:
+                break
+
+    # run ended due to worker error
+    if tile_finish is None:
+        return
+
+    # iterations of final count missing from tile band, outputs would not match master statistics
+    if tile_stats["n"] != tile_finish:
+        print("Tile - rank %d has %d of %d iterations" % (rank, tile_stats["n"], tile_finish))
+        comm.send(None, dest=0, tag=tags.FINISH)
+        return
+
+    (mean_aid, std_aid, var_aid) = statsResult(tile_stats, "aid")
+    (mean_count, std_count, var_count) = statsResult(tile_stats, "count")
+    error_surf = np.absolute(tile_surf - mean_aid)
+
+    tmp_outputs = [mean_aid, std_aid, var_aid, mean_count, std_count, var_count, error_surf]
+    for (tmp_name, tmp_data) in zip(tile_outputs, tmp_outputs):
+        fout = open(tilePartPath(tmp_name, t), "w")
+        fout.write(' '.join(np.char.mod('%f', tileFull(t, tmp_data))))
+        fout.close()
+
+    # statistics of tile band (iteration raster indices from tile_bounds[t])
+    with open(dir_working+"/stats_tile"+str(t)+".npz", 'wb') as f:
+        np.savez(f, n=tile_stats["n"], bounds=tile_bounds[t:t+2], full=tile_full[t:t+2],
+                 aid_sum=tile_stats["aid_sum"], aid_sumsq=tile_stats["aid_sumsq"],
+                 count_sum=tile_stats["count_sum"], count_sumsq=tile_stats["count_sumsq"])
+
+    comm.send((np.sum(mean_aid), np.sum(error_surf)), dest=0, tag=tags.FINISH)
+
+
+# --------------------------------------------------
+# local backend
+
+
+# stand in for worker ranks used by master with local backend
+# each task sent to a worker runs on the local pool and the worker
+# reports ready again once the task is done (same messages as workerLoop)
+class LocalTasks(object):
+
+    def __init__(self, workers):
+        self.replies = []
+        self.running = []
+        self.exited = list(range(1, workers+1))
+
+    def send(self, data, dest=0, tag=0):
+        # failed tasks are reported like workerLoop does (task and error)
+        if tag == tags.SURF:
+            self.running.append((workerPool().apply_async(surfWork, (data,)), tags.SURF_DONE, dest, data))
+
+        elif tag == tags.START:
+            self.running.append((workerPool().apply_async(iterResult, (data,)), tags.DONE, dest, data))
+
+        else:
+            # exit and error messages are confirmed by worker exiting
+            self.replies.append((None, tags.EXIT, dest))
+            self.exited.append(dest)
+
+    def recv(self, source=None, tag=None, status=None):
+        while len(self.replies) == 0:
+            if len(self.running) == 0:
+                # exited workers start their next worker loop (surf or iter)
+                self.replies = [(None, tags.READY, i) for i in self.exited]
+                self.exited = []
+                break
+
+            for item in self.running:
+                if item[0].ready():
+                    self.running.remove(item)
+                    try:
+                        self.replies.append((item[0].get(), item[1], item[2]))
+                    except Exception:
+                        self.replies.append(((item[3], traceback.format_exc()), tags.ERROR, item[2]))
+                    self.replies.append((None, tags.READY, item[2]))
+                    break
+            else:
+                self.running[0][0].wait(0.01)
+
+        (data, tag, source) = self.replies.pop(0)
+        status.source = source
+        status.tag = tag
+        return data
+
+
+# master side communicator and wildcards for receiving worker messages
+if backend == "local":
+    task_comm = LocalTasks(task_workers)
+    any_source = None
+    any_tag = None
+
+else:
+    task_comm = comm
+    any_source = MPI.ANY_SOURCE
+    any_tag = MPI.ANY_TAG
+
+
+# --------------------------------------------------
+# master mean surface functions
+
+
+# build mean surface from unit surfaces returned by workers
+# depends on master mean surface setup (unit_surf, surf_points, surf_polys)
+def surfFinish(new_unit_surf):
+    global unit_surf, sum_mean_surf
+
+    print("Surf Master - processing results")
+
+    if len(new_unit_surf) > 0:
+        unit_surf = unitAppend(unit_surf, new_unit_surf)
+        unitCacheSave(unit_surf)
+
+    # mean surface is the unit surface matrix times aid totals of each polygon geometry
+    geom_totals = surf_polys.groupby('geom_key')['split_dollars_pp'].sum()
+    sum_mean_surf = unitSurf(unit_surf, geom_totals, int(idx+1))
+
+    # plus aid of point locations added to the cell of each point
+    sum_mean_surf += np.bincount(surf_points.cell.values, weights=surf_points.split_dollars_pp.values, minlength=int(idx+1))
+
+    surfCacheSave(surf_hash, sum_mean_surf, surf_inputs)
+
+
+# validate and output mean surface once it is available
+def surfComplete():
+    global results_str, time_surf, T_surf, surf_ready
+
+    # validate sum_mean_surf
+    # exit if validation fails
+    if type(sum_mean_surf) == type(0):
+        print("! - mean surf validation failed")
+        comm.Abort(1)
+
+    # write asc file
+    sum_mean_surf_str = ' '.join(np.char.mod('%f', sum_mean_surf))
+    asc_sum_mean_surf_str = asc + sum_mean_surf_str
+    fout_sum_mean_surf = open(dir_working+"/mean_surf.asc", "w")
+    fout_sum_mean_surf.write(asc_sum_mean_surf_str)
+    fout_sum_mean_surf.close()
+
+    surf_ready = 1
+
+    # --------------------------------------------------
+
+    time_surf = time.time()
+    T_surf = int(time_surf - time_init)
+
+    results_str += "\nSurf Runtime\t" + str(T_surf//60) +'m '+ str(int(T_surf%60)) +'s'
+    results_str += "\nSurf Command\t" + str(run_mean_surf)
+    results_str += "\nSurf Pipelined\t" + str(int(surf_pipelined))
+    results_str += "\nIter Sampling\t" + str(iter_sampling)
+    results_str += "\nIter Dtype\t" + str(iter_dtype)
+
+    print('\tSurf Runtime: ' + str(T_surf//60) +'m '+ str(int(T_surf%60)) +'s')
+    print('\tSurf Command: ' + str(run_mean_surf))
+
+    print('\n')
+
+
+# next mean surface task to send to a worker
+# hybrid backend workers are sent a batch of tasks
+# returns task (or batch) and index of following task
+def surfNext(start):
+    if backend == "hybrid":
+        tmp_size = poolCount()
+        tmp_tasks = [t[0:3] for t in surf_tasks[start:start+tmp_size]]
+        return tmp_tasks, start + len(tmp_tasks)
+
+    return surf_tasks[start][0:3], start + 1
+
+
+# end of block of iterations starting at start
+# blocks are iter_batch iterations which do not cross an error check interval
+# iterations are folded into statistics of their block, which are then added to run statistics,
+# so statistics are the same whether blocks are folded by master, hybrid workers, sub-masters or tile ranks
+def iterBlockEnd(start):
+    end = min(start + iter_batch, len(i_control))
+    for interval in iter_interval:
+        if start < interval < end:
+            end = interval
+    return end
+
+
+# next iteration task to send to a worker
+# hybrid backend workers and sub-masters are sent a block of iterations
+# returns task (or batch) and index of following task
+# iteration tasks are (iteration, run seed)
+def iterNext(start):
+    if backend == "hybrid" or group_size != 0:
+        end = iterBlockEnd(start)
+        return [(i_control[i], run_seed) for i in range(start, end)], end
+
+    return (i_control[start], run_seed), start + 1
+
+
+# master side task messages with task_prefetch
+# tasks are sent without blocking and sends are completed while polling for worker messages
+# a worker is only sent exit once even if it has several free task slots
+task_sends = []
+task_exits = set()
+
+# tasks sent to each worker which have not returned a result yet (tag, task, time sent)
+# and time of last message from each worker
+task_outstanding = {}
+task_heard = {}
+
+# ready messages implied by task_prefetch, handled before next message from workers
+task_events = []
+
+# failed and lost tasks waiting to be sent again, workers waiting for them,
+# workers no longer sent tasks and those of them which stopped responding
+task_retry = []
+task_idle = []
+task_quarantine = set()
+task_lost = set()
+task_failures = {}
+task_counts = {"failures": 0, "reassigned": 0, "lost": 0, "quarantined": 0, "speculated": 0, "speculation_wins": 0}
+
+# seconds taken by each finished task by tag, time of last result from each worker,
+# tasks which have returned a result and tasks copied to another worker (worker running copy)
+task_latency = {}
+task_last = {}
+task_finished = set()
+task_speculated = {}
+
+def taskSend(data, dest, tag):
+    if tag in [tags.START, tags.SURF]:
+        task_outstanding.setdefault(dest, []).append((tag, data, time.time()))
+
+    if task_prefetch == 0:
+        task_comm.send(data, dest=dest, tag=tag)
+
+    elif tag != tags.EXIT or dest not in task_exits:
+        task_sends.append(comm.isend(data, dest=dest, tag=tag))
+        if tag == tags.EXIT:
+            task_exits.add(dest)
+
+
+# first iteration of an iteration task or batch
+def taskFirst(task):
+    return task[0][0] if isinstance(task, list) else task[0]
+
+
+# remove task from tasks outstanding at worker once its result (or error) arrives
+# workers run tasks in the order they were sent, sub-masters may finish batches out of order
+def taskDone(source, tag=None, iteration=None):
+    tmp_tasks = task_outstanding.get(source, [])
+    for j in range(len(tmp_tasks)):
+        if (tag is None or tmp_tasks[j][0] == tag) and (iteration is None or taskFirst(tmp_tasks[j][1]) == iteration):
+            return tmp_tasks.pop(j)
+    return None
+
+
+# check if any worker has tasks outstanding
+# copies of tasks which already returned a result from another worker are not counted
+def taskRunning():
+    return any(taskKey(t) not in task_finished for v in task_outstanding.values() for t in v)
+
+
+# task identity shared by copies of a task, iteration tasks by first iteration
+def taskKey(entry):
+    return entry[0], (taskFirst(entry[1]) if entry[0] == tags.START else repr(entry[1]))
+
+
+# time worker started running an outstanding task
+# workers run queued tasks (task_prefetch) once the task before them returns
+def taskStart(source, entry):
+    return max(entry[2], task_last.get(source, 0))
+
+
+# record result of a task from worker and time it took
+# returns 0 if a copy of the task already returned a result, which is then dropped
+def taskResult(source, tag, iteration=None):
+    tmp_time = time.time()
+    tmp_task = taskDone(source, tag, iteration)
+    tmp_start = task_last.get(source, 0)
+    task_last[source] = tmp_time
+
+    if tmp_task is None:
+        return 1
+
+    tmp_key = taskKey(tmp_task)
+    if tmp_key in task_finished:
+        return 0
+
+    # only the first result of a task counts towards the time its kind takes
+    # (a losing copy would add the time of a slow worker or of a task sent late)
+    task_latency.setdefault(tmp_task[0], []).append(tmp_time - max(tmp_task[2], tmp_start))
+
+    task_finished.add(tmp_key)
+    if task_speculated.get(tmp_key) == source:
+        task_counts["speculation_wins"] += 1
+
+    return 1
+
+
+# running task which has taken over task_speculate times the median time of its kind and was not copied yet
+# only the oldest outstanding task of each worker is running, the rest are queued
+# limited to iteration task starting at given iteration (the next one to fold) if given
+# tasks of the worker asking for one are skipped (a copy on the same worker gains nothing)
+# returns (worker, task) or None
+def taskStraggler(source, iteration=None):
+    if task_speculate == 0:
+        return None
+
+    tmp_time = time.time()
+    for (tmp_rank, tmp_tasks) in task_outstanding.items():
+        if len(tmp_tasks) == 0 or tmp_rank == source:
+            continue
+
+        tmp_task = tmp_tasks[0]
+        tmp_key = taskKey(tmp_task)
+        if tmp_key in task_finished or tmp_key in task_speculated:
+            continue
+        if iteration is not None and tmp_key != (tags.START, iteration):
+            continue
+
+        # median of recent tasks, task times change over the mean surface phase (largest tasks first)
+        tmp_latency = task_latency.get(tmp_task[0], [])[-100:]
+        if len(tmp_latency) < task_speculate_min:
+            continue
+
+        if tmp_time - taskStart(tmp_rank, tmp_task) > task_speculate * np.median(tmp_latency):
+            return tmp_rank, tmp_task
+
+    return None
+
+
+# median and 95th percentile of seconds taken by finished tasks of a kind (None without any)
+def taskSeconds(tag):
+    tmp_latency = task_latency.get(tag, [])
+    if len(tmp_latency) == 0:
+        return None, None
+    return float(np.median(tmp_latency)), float(np.percentile(tmp_latency, 95))
+
+
+# send copy of a straggling task to worker
+# returns 1 if a copy was sent
+def taskSpeculate(source, label, iteration=None):
+    tmp_straggler = taskStraggler(source, iteration)
+    if tmp_straggler is None:
+        return 0
+
+    (tmp_rank, tmp_task) = tmp_straggler
+    task_speculated[taskKey(tmp_task)] = source
+    task_counts["speculated"] += 1
+    taskSend(tmp_task[1], source, tmp_task[0])
+    print("%s Master - sending copy of task running on worker %d for %.1f seconds to worker %d" % (label, tmp_rank, time.time() - taskStart(tmp_rank, tmp_task), source))
+    return 1
+
+
+# worker with outstanding tasks which has not been heard from in task_timeout seconds
+def taskLost():
+    tmp_time = time.time()
+    for (tmp_rank, tmp_tasks) in task_outstanding.items():
+        if len(tmp_tasks) > 0 and tmp_time - max(task_heard.get(tmp_rank, 0), tmp_tasks[0][2]) > task_timeout:
+            return tmp_rank
+    return None
+
+
+# next message from workers to master as (data, source, tag)
+# polls for messages (matched probe, since results can be larger than a preposted receive buffer)
+# and completes task sends while waiting
+# a worker which timed out is returned as a LOST message from it
+# an idle worker is returned as a READY message once there is a straggling task to copy
+# sub-master heartbeats (ALIVE) only update time last heard from
+def taskRecv():
+    if task_prefetch == 0 and task_timeout == 0 and task_speculate == 0:
+        data = task_comm.recv(source=any_source, tag=any_tag, status=status)
+        return data, status.Get_source(), status.Get_tag()
+
+    while True:
+        msg = comm.improbe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+        if msg is not None:
+            data = msg.recv()
+            task_heard[status.Get_source()] = time.time()
+            if status.Get_tag() != tags.ALIVE:
+                return data, status.Get_source(), status.Get_tag()
+            continue
+
+        if task_timeout > 0:
+            tmp_lost = taskLost()
+            if tmp_lost is not None:
+                return None, tmp_lost, tags.LOST
+
+        for tmp_idle in task_idle:
+            if taskStraggler(tmp_idle) is not None:
+                task_idle.remove(tmp_idle)
+                return None, tmp_idle, tags.READY
+
+        task_sends[:] = [r for r in task_sends if not r.Test()]
+        time.sleep(task_poll)
+
+
+# stop sending tasks to a worker which failed too often or stopped responding
+# its outstanding tasks are run again by other workers and it counts as closed
+def taskQuarantine(source, label, lost):
+    global closed_workers
+
+    print("%s Master - quarantining worker %d (%s)" % (label, source, "lost" if lost else "failed tasks"))
+
+    task_quarantine.add(source)
+    tmp_tasks = [t for t in task_outstanding.pop(source, []) if taskKey(t) not in task_finished]
+    task_retry.extend([(t[0], t[1]) for t in tmp_tasks])
+    task_counts["reassigned"] += len(tmp_tasks)
+    closed_workers += 1
+
+    if lost:
+        # lost worker can not tell tile ranks it exited
+        task_counts["lost"] += 1
+        task_lost.add(source)
+        for tmp_rank in tile_ranks:
+            comm.send(None, dest=tmp_rank, tag=tags.EXIT)
+    else:
+        taskSend(None, source, tags.EXIT)
+
 
-filtered.agg_type = filtered.apply(lambda x: geomType(x[is_geocoded], x[code_field]), axis=1)
-filtered.agg_geom = filtered.apply(lambda x: geomVal(x.agg_type, x[code_field], x.longitude, x.latitude), axis=1)
+# worker messages handled the same way by mean surface and iteration masters
+# (results of quarantined workers, exits, failed tasks and lost workers)
+# returns 1 if message was handled
+def taskHandle(data, source, tag, label):
+    global closed_workers
 
-i_m = filtered.loc[filtered.agg_geom != "None"].copy(deep=True)
+    if source in task_quarantine:
+        # results of quarantined workers were given to other workers
+        return 1
+
+    elif tag == tags.EXIT:
+        print("%s Master - worker %d exited." % (label, source))
+        closed_workers += 1
 
+        # sub-masters report failures of their workers and may exit with unfinished batches
+        if data is not None:
+            task_counts["failures"] += data[0]
+            task_counts["reassigned"] += data[1]
+            task_counts["quarantined"] += data[2]
+            task_counts["lost"] += data[3]
 
-# i_m['index'] = i_m['project_location_id']
-i_m['unique'] = range(0, len(i_m))
-i_m['index'] = range(0, len(i_m))
-i_m = i_m.set_index('index')
+        tmp_tasks = [t for t in task_outstanding.pop(source, []) if taskKey(t) not in task_finished]
+        task_retry.extend([(t[0], t[1]) for t in tmp_tasks])
+        task_counts["reassigned"] += len(tmp_tasks)
+        return 1
 
+    elif tag == tags.ERROR:
+        # failed task is sent again to any worker
+        print("%s Master - task failed on worker %d." % (label, source))
+        print(data[1])
 
-# ====================================================================================================
-# ====================================================================================================
-# master init
+        tmp_task = taskDone(source)
+        task_last[source] = time.time()
+        if tmp_task is not None and taskKey(tmp_task) not in task_finished:
+            task_retry.append((tmp_task[0], tmp_task[1]))
+            task_counts["reassigned"] += 1
 
+        task_counts["failures"] += 1
+        task_failures[source] = task_failures.get(source, 0) + 1
 
-if rank == 0:
+        if task_failures[source] >= task_failures_max:
+            taskQuarantine(source, label, 0)
+        return 1
 
-    # --------------------------------------------------
-    # initialize results file output
+    elif tag == tags.LOST:
+        print("%s Master - no message from worker %d in %d seconds." % (label, source, task_timeout))
+        taskQuarantine(source, label, 1)
+        return 1
 
-    results_str = "Monte Carlo Rasterization Output File\t "
+    return 0
 
-    results_str += "\nstart time\t" + str(Ts)
-    results_str += "\ncountry\t" + str(country)
-    results_str += "\nabbr\t" + str(abbr)
-    results_str += "\npixel_size\t" + str(pixel_size)
-    results_str += "\niter_max\t" + str(iter_max)
-    results_str += "\nnodata\t" + str(nodata)
-    results_str += "\naid_field\t" + str(aid_field)
-    results_str += "\ncode_field\t" + str(code_field)
-    results_str += "\ncountry bounds\t" + str((adm0_minx, adm0_miny, adm0_maxx, adm0_maxy))
 
-    results_str += "\nrows\t" + str(len(rows))
-    results_str += "\ncolumns\t" + str(len(cols))
-    results_str += "\nlocations\t" + str(len(i_m))
+# idle workers are sent tasks to run again, or exit once no tasks are outstanding
+def taskWake(tag):
+    if tag in [tags.DONE, tags.SURF_DONE, tags.ERROR, tags.LOST, tags.EXIT] and len(task_idle) > 0:
+        task_events.extend([(None, w, tags.READY) for w in task_idle])
+        del task_idle[:]
 
-    # results_str += "\nfilters\t" + str(filters)
 
+# error percent of mean aid of statistics against mean surface
+# tile ranks each return their sums of mean aid and error in tiled mode
+def iterError(stats):
+    if iter_tiles > 0:
+        for tmp_rank in tile_ranks:
+            comm.send(stats["n"], dest=tmp_rank, tag=tags.CHECK)
 
-    # --------------------------------------------------
-    # initialize asc file output
+        tmp_sums = [comm.recv(source=tmp_rank, tag=tags.CHECK) for tmp_rank in tile_ranks]
+        return sum(x[1] for x in tmp_sums) / sum(x[0] for x in tmp_sums)
 
-    asc = ""
-    asc += "NCOLS " + str(len(cols)) + "\n"
-    asc += "NROWS " + str(len(rows)) + "\n"
+    this_mean_aid = stats["aid_sum"] / stats["n"]
 
-    # asc += "XLLCORNER " + str(adm0_minx-pixel_size*0.5) + "\n"
-    # asc += "YLLCORNER " + str(adm0_miny-pixel_size*0.5) + "\n"
+    this_sum_aid = np.sum(this_mean_aid)
 
-    asc += "XLLCENTER " + str(adm0_minx) + "\n"
-    asc += "YLLCENTER " + str(adm0_miny) + "\n"
+    this_error_surf = np.absolute(np.subtract(cellCompact(sum_mean_surf), this_mean_aid))
 
-    asc += "CELLSIZE " + str(pixel_size) + "\n"
-    asc += "NODATA_VALUE " + str(nodata) + "\n"
+    this_error_log_sum = np.sum(np.absolute(this_error_surf))
+    return this_error_log_sum / this_sum_aid
 
 
-    # --------------------------------------------------
-    # build output directories
+# finish tiled iterations with final iteration count (None after worker error)
+# tile ranks write their parts of asc outputs, which are joined in row order
+# returns sums of mean aid and error over all tiles (None if any tile is incomplete)
+def tileFinish(n):
+    for tmp_rank in tile_ranks:
+        comm.send(n, dest=tmp_rank, tag=tags.FINISH)
 
-    make_dir(dir_working)
+    if n is None:
+        return None
 
+    tmp_sums = [comm.recv(source=tmp_rank, tag=tags.FINISH) for tmp_rank in tile_ranks]
 
-    # --------------------------------------------------
-    # record init runtime
+    if None in tmp_sums:
+        for t in range(iter_tiles):
+            if tmp_sums[t] is None:
+                continue
+            for tmp_name in tile_outputs:
+                os.remove(tilePartPath(tmp_name, t))
+            os.remove(dir_working+"/stats_tile"+str(t)+".npz")
+        return None
 
-    time_init = time.time()
-    T_init = int(time_init - Ts)
+    for tmp_name in tile_outputs:
+        fout = open(dir_working+"/"+tmp_name+".asc", "w")
+        fout.write(asc)
+        for t in range(iter_tiles):
+            if t > 0:
+                fout.write(' ')
+            with open(tilePartPath(tmp_name, t)) as fpart:
+                shutil.copyfileobj(fpart, fout)
+            os.remove(tilePartPath(tmp_name, t))
+        fout.close()
 
-    results_str += "\nInit Runtime\t" + str(T_init//60) +'m '+ str(int(T_init%60)) +'s'
-    print('\tInit Runtime: ' + str(T_init//60) +'m '+ str(int(T_init%60)) +'s')
+    return sum(x[0] for x in tmp_sums), sum(x[1] for x in tmp_sums)
 
 
-# ====================================================================================================
-# ====================================================================================================
+# check if error value is due to be checked at the next iter_interval
+def iterCheckDue():
+    return check_index < len(iter_interval) and iter_stats["n"] >= iter_interval[check_index]
 
-comm.Barrier()
-# sys.exit("! - init only")
 
-# ====================================================================================================
-# ====================================================================================================
-# mpi prep
+# next iteration to fold
+def iterFoldNext():
+    return iter_stats["n"] + iter_block["n"]
 
 
-# terminate if master init fails
-#
+# fold completed iterations into statistics in iteration order
+# so statistics do not depend on number of workers or order tasks finish in
+# stops at each iter_interval until the error value has been checked there
+# until the mean surface is ready (pipelined mode) folding goes on and a copy of the statistics
+# at each interval is kept for its check instead, so results do not wait in iter_pending
+# hybrid workers and sub-masters send statistics of a whole block, keyed by first iteration of block
+def iterFold():
+    global iter_block
 
-# Define MPI message tags
-tags = enum('READY', 'DONE', 'EXIT', 'START', 'ERROR')
+    while iterFoldNext() in iter_pending and not (surf_ready and iterCheckDue()):
+        tmp_result = iter_pending.pop(iterFoldNext())
+        if isinstance(tmp_result, dict):
+            statsMerge(iter_stats, tmp_result)
 
+        else:
+            statsAdd(iter_block, tmp_result)
+            if iterFoldNext() != iterBlockEnd(iter_stats["n"]):
+                continue
 
-# init for later
-sum_mean_surf = 0
+            statsMerge(iter_stats, iter_block)
+            iter_block = statsNew(len(iter_stats["aid_sum"]))
 
-# check if mean surf exists
-load_mean_surf = dir_outputs+"/mean_surf.npy"
-run_mean_surf = 1
-if os.path.isfile(load_mean_surf) and not force_mean_surf:
-    run_mean_surf = 0
+        if not surf_ready and iter_stats["n"] in iter_interval[check_index:]:
+            iter_snapshots[iter_stats["n"]] = statsCopy(iter_stats)
 
 
 # ====================================================================================================
@@ -655,196 +3085,142 @@ if os.path.isfile(load_mean_surf) and not force_mean_surf:
 
 
 if rank == 0 and run_mean_surf == 0:
-    sum_mean_surf = np.load(load_mean_surf)
+    print("Surf Master - using cached mean surface " + surf_hash)
 
 elif rank == 0 and run_mean_surf == 1:
 
     # ==================================================
     # MASTER START STUFF
 
-    all_mean_surf = []
-    unique_ids = i_m['unique']
-
-    # ==================================================
-
-    task_index = 0
-    num_workers = size - 1
-    closed_workers = 0
-    err_status = 0
-    print("Surf Master - starting with %d workers" % num_workers)
-
-    # distribute work
-    while closed_workers < num_workers:
-        data = comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
-        source = status.Get_source()
-        tag = status.Get_tag()
-
-        if tag == tags.READY:
-
-            if task_index < len(unique_ids):
-
-                #
-                # !!!
-                #   to do:
-                #   if task if for a point (not point with small buffer, etc.)
-                #   then let master do work
-                #   run tests to see if this actually improves runtimes
-                # !!!
-                #
+    # point locations are handled by master in a single pass
+    # only polygon geometries are sent to workers
+    surf_points = i_m.loc[i_m.agg_type == "point"]
+    surf_polys = i_m.loc[i_m.agg_type != "point"]
 
-                comm.send(unique_ids[task_index], dest=source, tag=tags.START)
-                print("Surf Master - sending task %d to worker %d" % (task_index, source))
-                task_index += 1
+    # unit surfaces only need to be generated for geometries not already cached
+    # forced runs regenerate unit surfaces of all their geometries
+    unit_surf = unitCacheLoad()
 
-            else:
-                comm.send(None, dest=source, tag=tags.EXIT)
+    if force_mean_surf:
+        unit_surf = unitRemove(unit_surf, set(surf_polys.geom_key))
 
-        elif tag == tags.DONE:
+    unit_keys = set(unit_surf["keys"])
 
-            # ==================================================
-            # MASTER MID STUFF
+    unique_ids = list(surf_polys.loc[~surf_polys.geom_key.isin(unit_keys)].drop_duplicates('geom_key')['unique'])
 
-            all_mean_surf.append(data)
-            print("Surf Master - got surf data from worker %d" % source)
+    print("Surf Master - %d point locations, %d polygon locations" % (len(surf_points), len(surf_polys)))
+    print("Surf Master - %d of %d unique polygon geometries cached" % (len(set(surf_polys.geom_key) & unit_keys), len(set(surf_polys.geom_key))))
 
-            # ==================================================
+    # split large geometries into tiles and order tasks by estimated cost, largest first
+    for unique_id in unique_ids:
+        surf_tasks += geomTasks(unique_id, locGeom(unique_id))
 
-        elif tag == tags.EXIT:
-            print("Surf Master - worker %d exited." % source)
-            closed_workers += 1
+    surf_tasks.sort(key=lambda x: x[3], reverse=True)
 
-        elif tag == tags.ERROR:
-            print("Surf Master - error reported by surf worker %d ." % source)
-            # broadcast error to all workers
-            for i in range(1, size):
-                comm.send(None, dest=i, tag=tags.ERROR)
+    print("Surf Master - %d tasks for %d geometries" % (len(surf_tasks), len(unique_ids)))
 
-            err_status = 1
-            break
+    results_str += "\nsurf point locations\t" + str(len(surf_points))
+    results_str += "\nsurf polygon locations\t" + str(len(surf_polys))
+    results_str += "\nsurf polygon geometries\t" + str(len(set(surf_polys.geom_key)))
+    results_str += "\nsurf worker tasks\t" + str(len(surf_tasks))
 
     # ==================================================
-    # MASTER END STUFF
 
-    if err_status == 0:
-        # calc results
-        print("Surf Master - processing results")
+    if surf_pipelined:
+        # surf tasks are handed out by iteration master ahead of iteration tasks
+        print("Surf Master - pipelined with iterations")
 
-        stack_mean_surf = np.vstack(all_mean_surf)
-        sum_mean_surf = np.sum(stack_mean_surf, axis=0)
-        save_mean_surf = dir_outputs+"/mean_surf.npy"
-        np.save(save_mean_surf, sum_mean_surf)
-
-        # write asc file
-        sum_mean_surf_str = ' '.join(np.char.mod('%f', sum_mean_surf))
-        asc_sum_mean_surf_str = asc + sum_mean_surf_str
-        fout_sum_mean_surf = open(dir_outputs+"/mean_surf.asc", "w")
-        fout_sum_mean_surf.write(asc_sum_mean_surf_str)
+        if len(surf_tasks) == 0:
+            surfFinish(all_unit_surf)
+            surfComplete()
 
     else:
-        print("Surf Master - terminating due to worker error.")
-
-    # ==================================================
-
-
-elif run_mean_surf == 1:
-    # Worker processes execute code below
-    name = MPI.Get_processor_name()
-    print("Surf Worker - rank %d on %s." % (rank, name))
-    while True:
-        comm.send(None, dest=0, tag=tags.READY)
-        task = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
-        tag = status.Get_tag()
-
-        if tag == tags.START:
-
-            # ==================================================
-            # WORKER STUFF
-
-            mean_surf = np.zeros((int(idx+1),), dtype=np.int)
-
-            # poly grid pixel size and poly grid pixel size inverse
-            # poly grid pixel size is 1 order of magnitude higher resolution than output pixel_size
-            pg_pixel_size = pixel_size * 0.1
-            pg_psi = 1/pg_pixel_size
 
-            pg_data = i_m.loc[task]
-            pg_type = pg_data.agg_type
+        task_index = 0
+        num_workers = task_workers
+        closed_workers = 0
+        err_status = 0
+        print("Surf Master - starting with %d workers" % num_workers)
 
+        # distribute work
+        while closed_workers < num_workers:
+            if len(task_events) > 0:
+                (data, source, tag) = task_events.pop(0)
+            else:
+                (data, source, tag) = taskRecv()
 
-            if (pg_type != "point" and pg_type in agg_types) or pg_type == "country":
-
-                # for each row generate grid based on bounding box of geometry
+            if taskHandle(data, source, tag, "Surf"):
+                pass
 
-                pg_geom = pg_data.agg_geom
+            elif tag == tags.READY:
 
-                (pg_minx, pg_miny, pg_maxx, pg_maxy) = pg_geom.bounds
-                # print( (pg_minx, pg_miny, pg_maxx, pg_maxy) )
+                if len(task_retry) > 0:
+                    (tmp_tag, tmp_task) = task_retry.pop(0)
+                    taskSend(tmp_task, source, tmp_tag)
+                    print("Surf Master - sending failed task again to worker %d" % source)
 
-                (pg_minx, pg_miny, pg_maxx, pg_maxy) = (math.floor(pg_minx*pg_psi)/pg_psi, math.floor(pg_miny*pg_psi)/pg_psi, math.ceil(pg_maxx*pg_psi)/pg_psi, math.ceil(pg_maxy*pg_psi)/pg_psi)
-                # print( (pg_minx, pg_miny, pg_maxx, pg_maxy) )
+                elif task_index < len(surf_tasks):
+                    (tmp_task, tmp_index) = surfNext(task_index)
+                    taskSend(tmp_task, source, tags.SURF)
+                    print("Surf Master - sending task %d to worker %d" % (task_index, source))
+                    task_index = tmp_index
 
-                pg_cols = np.arange(pg_minx, pg_maxx+pg_pixel_size*0.5, pg_pixel_size)
-                pg_rows = np.arange(pg_maxy, pg_miny-pg_pixel_size*0.5, -1*pg_pixel_size)
+                elif taskSpeculate(source, "Surf"):
+                    pass
 
-                # evenly split the aid for that row (i_m['split_dollars_pp'] field) among new grid points
+                elif taskRunning():
+                    # tasks of other workers may still fail or straggle
+                    task_idle.append(source)
 
-                # full poly grid reference object and count
-                pg_gref = {}
-                pg_idx = 0
+                else:
+                    task_comm.send(None, dest=source, tag=tags.EXIT)
 
-                # poly grid points within actual geom and count
-                # pg_in = {}
-                pg_count = 0
+            elif tag == tags.SURF_DONE and not taskResult(source, tags.SURF):
+                print("Surf Master - dropped surf data from worker %d (copy already returned)" % source)
 
-                for r in pg_rows:
-                    pg_gref[str(r)] = {}
+            elif tag == tags.SURF_DONE:
 
-                    for c in pg_cols:
-                        pg_idx += 1
+                # ==================================================
+                # MASTER MID STUFF
 
-                        # check if point is within geom
-                        pg_point = Point(c,r)
-                        pg_within = pg_point.within(pg_geom)
+                if backend == "hybrid":
+                    all_unit_surf.extend(data)
+                else:
+                    all_unit_surf.append(data)
 
-                        if pg_within:
-                            pg_gref[str(r)][str(c)] = pg_idx
-                            pg_count += 1
-                        else:
-                            pg_gref[str(r)][str(c)] = "None"
+                print("Surf Master - got surf data from worker %d" % source)
 
+                # ==================================================
 
-                # init grid reference object
-                for r in pg_rows:
-                    for c in pg_cols:
-                        if pg_gref[str(r)][str(c)] != "None":
-                            # round new grid points to old grid points and update old grid
-                            gref_id = gref[str(round(r * psi) / psi)][str(round(c * psi) / psi)]
-                            mean_surf[gref_id] += pg_data['split_dollars_pp'] / pg_count
+            taskWake(tag)
 
+        # ==================================================
+        # MASTER END STUFF
 
-            elif pg_type == "point":
+        if task_prefetch > 0:
+            MPI.Request.Waitall(task_sends)
 
-                # round new grid points to old grid points and update old grid
-                gref_id = gref[str(round(pg_data.latitude * psi) / psi)][str(round(pg_data.longitude * psi) / psi)]
-                mean_surf[gref_id] += pg_data['split_dollars_pp']
+        # quarantined workers are sent exit again for iterations
+        task_exits.clear()
 
+        # every worker was quarantined before all tasks were done
+        if len(task_retry) > 0 or task_index < len(surf_tasks):
+            err_status = 1
 
-            # --------------------------------------------------
-            # send np arrays back to master
+        if err_status == 0:
+            surfFinish(all_unit_surf)
 
-            comm.send(mean_surf, dest=0, tag=tags.DONE)
+        else:
+            # other ranks wait for iterations to start
+            print("Surf Master - terminating due to worker error.")
+            comm.Abort(1)
 
-            # ==================================================
+        # ==================================================
 
-        elif tag == tags.EXIT:
-            comm.send(None, dest=0, tag=tags.EXIT)
-            break
 
-        elif tag == tags.ERROR:
-            print("Surf Worker - error message from Surf Master. Shutting down." % source)
-            # confirm error message received and exit
-            comm.send(None, dest=0, tag=tags.EXIT)
-            break
+elif run_mean_surf == 1 and not surf_pipelined and rank not in tile_ranks:
+    # Worker processes execute code below
+    workerLoop("Surf")
 
 
 # elif run_mean_surf == 2 and rank == 0:
@@ -861,34 +3237,85 @@ elif run_mean_surf == 1:
 #     np.save(save_mean_surf, sum_mean_surf)
 
 
-if rank == 0:
+if rank == 0 and not surf_pipelined:
+    surfComplete()
 
-    # validate sum_mean_surf
-    # exit if validation fails
-    if type(sum_mean_surf) == type(0):
-        sys.exit("! - mean surf validation failed")
 
-    # --------------------------------------------------
+# ====================================================================================================
+# ====================================================================================================
 
-    time_surf = time.time()
-    T_surf = int(time_surf - time_init)
+# ranks lost during mean surface tasks can not take part in collective steps
+# so instead of a barrier master sends every other rank the list of lost ranks
+# (a lost rank which is still running is left behind and aborted at the end of the run)
+iter_lost = []
+
+if not surf_pipelined:
+    if rank == 0:
+        iter_lost = sorted(task_lost)
+        for tmp_rank in range(1, size):
+            if tmp_rank not in task_lost:
+                comm.send(iter_lost, dest=tmp_rank, tag=tags.INIT)
+    else:
+        iter_lost = comm.recv(source=0, tag=tags.INIT)
 
-    results_str += "\nSurf Runtime\t" + str(T_surf//60) +'m '+ str(int(T_surf%60)) +'s'
-    results_str += "\nSurf Command\t" + str(run_mean_surf)
+if mean_surf_only == 1:
+    if rank == 0 and len(iter_lost) > 0:
+        print("Surf Master - aborting lost workers")
+        comm.Abort(1)
+    sys.exit("! - mean surf only")
 
-    print('\tSurf Runtime: ' + str(T_surf//60) +'m '+ str(int(T_surf%60)) +'s')
-    print('\tSurf Command: ' + str(run_mean_surf))
 
-    print('\n')
+# --------------------------------------------------
+# alias tables for iteration cell sampling
 
+# built by master from unit surfaces and sent to all ranks
+# in node shared mode only the first rank on each node receives them
+# after lost workers they are sent to each remaining rank, node shared data needs every rank on the node
 
-# ====================================================================================================
-# ====================================================================================================
+if iter_sampling == "alias":
 
-comm.Barrier()
+    if rank == 0:
+        if run_mean_surf == 0:
+            unit_surf = unitCacheLoad()
+        alias_data = aliasTables(unit_surf)
+    else:
+        alias_data = None
 
-if mean_surf_only == 1:
-    sys.exit("! - mean surf only")
+    if rank == 0 and node_shared and len(iter_lost) > 0:
+        print("Surf Master - node shared alias tables can not be set up after lost workers")
+        comm.Abort(1)
+
+    if node_shared:
+        if node_rank == 0:
+            alias_data = leader_comm.bcast(alias_data, root=0)
+
+        alias_data = dict((f, nodeShared(alias_data[f] if node_rank == 0 else None)) for f in ["offset", "cells", "weights", "prob", "alias", "loc_table"])
+
+    elif len(iter_lost) == 0:
+        alias_data = comm.bcast(alias_data, root=0)
+
+    elif rank == 0:
+        for tmp_rank in range(1, size):
+            if tmp_rank not in task_lost:
+                comm.send(alias_data, dest=tmp_rank, tag=tags.INIT)
+
+    else:
+        alias_data = comm.recv(source=0, tag=tags.INIT)
+
+    # locations of geometries shared by at least iter_group_min locations are drawn as groups
+    # (positions in split_polys)
+    tmp_tables = alias_data["loc_table"][split_polys]
+    tmp_counts = np.bincount(tmp_tables, minlength=len(alias_data["offset"]) - 1)
+
+    alias_single = np.flatnonzero(tmp_counts[tmp_tables] < iter_group_min)
+    alias_single_tables = tmp_tables[alias_single]
+    alias_groups = [(t, np.flatnonzero(tmp_tables == t)) for t in np.flatnonzero(tmp_counts >= iter_group_min)]
+
+    if rank == 0:
+        results_str += "\nIter Sampling Groups\t" + str(len(alias_groups))
+
+    # pool processes created during mean surf do not have alias tables
+    poolReset()
 
 # ====================================================================================================
 # ====================================================================================================
@@ -901,181 +3328,376 @@ if rank == 0:
     # ==================================================
     # MASTER START STUFF
 
-    total_aid = []
-    total_count = []
+    # start of iteration phase (mean surface tasks may still run in pipelined mode)
+    time_iter = time.time()
+
+    # sufficient statistics of completed iterations
+    # only the number of iterations is kept by master in tiled mode
+    iter_stats = statsNew(grid_size if iter_tiles == 0 else 0)
 
-    task_index = 0
-    num_workers = size - 1
+    # completed iterations waiting for earlier iterations to finish
+    iter_pending = {}
+
+    # statistics at intervals folded past before mean surface was ready, by interval (see iterFold)
+    iter_snapshots = {}
+
+    if run_seed is None:
+        run_seed = random.SystemRandom().randint(0, 2**63 - 1)
+
+    # iteration intervals checked and their error percent values
+    iter_checks = []
+
+    # iterations of finished run being extended and of checkpoint being resumed from
+    iter_extended_from = 0
+    iter_resumed = 0
+
+    # extend finished run with additional iterations
+    # new iterations have their own random streams and early stopping is skipped so all iterations are run
+    if iter_extend > 0:
+        (iter_stats, run_seed, iter_checks) = iterStateLoad(statsPath())
+        iter_extended_from = iter_stats["n"]
+        iter_max = iter_stats["n"] + iter_extend
+        i_control = range(int(iter_max))
+        print("Iter Master - extending %d iterations by %d" % (iter_stats["n"], iter_extend))
+
+    # resume from last checkpoint of an interrupted run with the same Rid
+    # tiled runs do not checkpoint
+    iter_checkpoint = iterStateLoad(checkpointPath()) if iter_tiles == 0 else None
+    if iter_checkpoint is not None:
+        (iter_stats, run_seed, iter_checks) = iter_checkpoint
+        print("Iter Master - resuming from checkpoint at %d iterations" % iter_stats["n"])
+        iter_resumed = iter_stats["n"]
+
+    # statistics of iterations folded in current block (see iterBlockEnd)
+    iter_block = statsNew(len(iter_stats["aid_sum"]))
+    checkpoint_time = time.time()
+
+    task_index = iter_stats["n"]
+    num_workers = len(iter_workers)
     closed_workers = 0
     err_status = 0
+    iter_stop = 0
     last_error_log_percent = 1.0
 
-    print("Iter Master - starting with %d workers" % (num_workers))
+    # next iter_interval to check error value at
+    check_index = len(iter_checks)
+    if iter_extend > 0:
+        check_index = len(iter_interval)
 
-    # ==================================================
+    # mean surface tasks still to be handed out (pipelined mode only)
+    surf_index = 0
+    if not surf_pipelined:
+        surf_tasks = []
+
+    # tile ranks get mean surface of their band
+    for t in range(iter_tiles):
+        comm.send(cellCompact(sum_mean_surf)[tile_bounds[t]:tile_bounds[t+1]], dest=tile_ranks[t], tag=tags.TILE)
+
+    # workers quarantined during mean surface tasks are only sent exit
+    # (sub-masters quarantine workers of their group themselves, lost workers are left out of groups,
+    # only lost sub-masters stay quarantined)
+    if group_size != 0:
+        task_quarantine.intersection_update(task_lost & set(iter_workers))
+
+    for tmp_rank in task_quarantine:
+        if tmp_rank not in task_lost:
+            taskSend(None, tmp_rank, tags.EXIT)
+        closed_workers += 1
 
+    print("Iter Master - starting with %d workers" % (num_workers - closed_workers))
+
+    # ==================================================
 
     # distribute work
     while closed_workers < num_workers:
-        data = comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
-        source = status.Get_source()
-        tag = status.Get_tag()
+        if len(task_events) > 0:
+            (data, source, tag) = task_events.pop(0)
 
-        if tag == tags.READY:
+        else:
+            (data, source, tag) = taskRecv()
 
-            # check error value at intervals
-            this_interval = len(total_aid)
+            # worker is sent a task for every free slot, results free a slot
+            if task_prefetch > 0 and tag == tags.READY:
+                task_events += [(None, source, tags.READY)] * task_prefetch
+            elif task_prefetch > 0 and tag in [tags.DONE, tags.SURF_DONE, tags.ERROR]:
+                task_events.append((None, source, tags.READY))
 
-            if this_interval in iter_interval:
+        if taskHandle(data, source, tag, "Iter"):
+            pass
 
-                # check error percent value
-                this_stack_aid = np.vstack(total_aid[0:this_interval])
-                this_mean_aid = np.mean(this_stack_aid, axis=0)
+        elif tag == tags.READY and surf_index < len(surf_tasks):
+
+            # mean surface tasks go out ahead of iterations
+            (tmp_task, tmp_index) = surfNext(surf_index)
+            taskSend(tmp_task, source, tags.SURF)
+            print("Iter Master - sending surf task %d to worker %d" % (surf_index, source))
+            surf_index = tmp_index
+
+        elif tag == tags.READY:
+
+            # check error value at intervals
+            # checks are deferred until the mean surface is available
+            while surf_ready and iterCheckDue():
+
+                this_interval = iter_interval[check_index]
+                check_index += 1
 
-                this_sum_aid = np.sum(this_mean_aid)
+                # statistics at interval, already folded past if it was reached before mean surface was ready
+                this_stats = iter_snapshots.pop(this_interval, iter_stats)
 
-                this_error_surf = np.absolute(np.subtract(sum_mean_surf, this_mean_aid))
+                # check error percent value
+                this_error_log_percent = iterError(this_stats)
 
-                this_error_log_sum = np.sum(np.absolute(this_error_surf))
-                this_error_log_percent =  this_error_log_sum / this_sum_aid
+                iter_checks.append([this_interval, float(this_error_log_percent)])
 
                 # determine if threshold is met
                 if this_error_log_percent < iter_thresh:
                     # end if threshold is met
                     print("Iter Master - thresh met at %d iterations" % this_interval)
-                    iterations = this_interval
-
-                    for i in range(1, size):
-                        comm.send(None, dest=i, tag=tags.EXIT)
-
+                    iter_stop = 1
                     break
 
                 elif (last_error_log_percent - this_error_log_percent) < iter_improvement:
                     # end if minimal improvement threshold is met
                     print("Iter Master - minimal improvement thresh met at %d iterations" % this_interval)
-                    iterations = this_interval
-
-                    for i in range(1, size):
-                        comm.send(None, dest=i, tag=tags.EXIT)
-
+                    iter_stop = 1
                     break
 
                 else:
                     # keep going if threshold not met
                     print("Iter Master - thresh not met at %d iterations" % this_interval)
+                    for tmp_rank in tile_ranks:
+                        comm.send(None, dest=tmp_rank, tag=tags.START)
+                    iterFold()
+
+
+            if iter_stop == 1:
+                # run ends with statistics of interval it stopped at
+                iter_stats = this_stats
+                iterations = iter_stats["n"]
+
+                for i in iter_workers:
+                    if i not in task_quarantine:
+                        taskSend(None, i, tags.EXIT)
 
+                break
 
-            if task_index < len(i_control):
-                comm.send(i_control[task_index], dest=source, tag=tags.START)
+
+            # no checkpoints while intervals folded past wait for their checks
+            if checkpoint_interval > 0 and iter_tiles == 0 and len(iter_snapshots) == 0 and time.time() - checkpoint_time >= checkpoint_interval:
+                iterStateSave(checkpointPath(), iter_stats, run_seed, iter_checks)
+                checkpoint_time = time.time()
+                print("Iter Master - checkpoint at %d iterations" % iter_stats["n"])
+
+
+            if len(task_retry) > 0:
+                (tmp_tag, tmp_task) = task_retry.pop(0)
+                taskSend(tmp_task, source, tmp_tag)
+                print("Iter Master - sending failed task again to worker %d" % source)
+
+            elif taskSpeculate(source, "Iter", iterFoldNext()):
+                # straggler holds up folding and the next error check
+                pass
+
+            elif task_index < len(i_control):
+                (tmp_task, tmp_index) = iterNext(task_index)
+                taskSend(tmp_task, source, tags.START)
                 print("Iter Master - sending task %d to worker %d" % (task_index, source))
-                task_index += 1
+                task_index = tmp_index
+
+            elif taskSpeculate(source, "Iter"):
+                pass
+
+            elif taskRunning():
+                # tasks of other workers may still fail and need to be sent again
+                task_idle.append(source)
 
             else:
                 iterations = task_index
-                comm.send(None, dest=source, tag=tags.EXIT)
+                taskSend(None, source, tags.EXIT)
+
+        elif tag == tags.SURF_DONE and not taskResult(source, tags.SURF):
+            print("Iter Master - dropped surf data from worker %d (copy already returned)" % source)
+
+        elif tag == tags.SURF_DONE:
+
+            if backend == "hybrid":
+                all_unit_surf.extend(data)
+            else:
+                all_unit_surf.append(data)
+
+            print("Iter Master - got surf data from worker %d" % source)
+
+            if len(all_unit_surf) == len(surf_tasks):
+                surfFinish(all_unit_surf)
+                surfComplete()
+
+        elif tag == tags.DONE and not taskResult(source, tags.START, data[0]):
+            print("Iter Master - dropped data from worker %d (copy already returned)" % source)
 
         elif tag == tags.DONE:
 
             # ==================================================
             # MASTER MID STUFF
 
-            total_aid.append(data[0])
-            total_count.append(data[1])
+            # hybrid backend workers and sub-masters send statistics of a block of iterations
+            iter_pending[data[0]] = data[1]
+
+            iterFold()
             print("Iter Master - got data from worker %d" % source)
 
             # ==================================================
 
-        elif tag == tags.EXIT:
-            print("Iter Master - worker %d exited." % source)
-            closed_workers += 1
-
-        elif tag == tags.ERROR:
-            print("Iter Master - error reported by worker %d ." % source)
-            # broadcast error to all workers
-            for i in range(1, size):
-                comm.send(None, dest=i, tag=tags.ERROR)
-
-            err_status = 1
-            break
+        taskWake(tag)
 
     # ==================================================
     # MASTER END STUFF
 
+    if task_prefetch > 0:
+        MPI.Request.Waitall(task_sends)
+
+    # workers told to exit mid task (run stopped at an error check) still send their results,
+    # which are received so no message is left unmatched at shutdown
+    # tile ranks receive results until every worker has exited
+    # sub-masters finish tasks they already have before exiting
+    while closed_workers < num_workers:
+        (data, source, tag) = taskRecv()
+        if tag == tags.EXIT and source not in task_quarantine:
+            closed_workers += 1
+        elif tag in [tags.DONE, tags.ERROR]:
+            taskDone(source)
+        elif tag == tags.LOST:
+            taskQuarantine(source, "Iter", 1)
+
+    # every worker was quarantined or lost before all iterations were folded
+    # folded statistics are kept as checkpoint so run can be resumed, final statistics and outputs are not written
+    if iter_stop == 0 and (iter_stats["n"] < len(i_control) or not surf_ready):
+        err_status = 1
+
+        # statistics at first interval not checked yet, if folded past it
+        if len(iter_snapshots) > 0:
+            iter_stats = iter_snapshots[min(iter_snapshots)]
+
+        if checkpoint_interval > 0 and iter_tiles == 0:
+            iterStateSave(checkpointPath(), iter_stats, run_seed, iter_checks)
+            print("Iter Master - checkpoint at %d iterations" % iter_stats["n"])
+
+    if iter_tiles > 0:
+        tile_sums = tileFinish(iter_stats["n"] if err_status == 0 else None)
+        if tile_sums is None and err_status == 0:
+            print("Iter Master - tile statistics incomplete")
+            err_status = 1
+
     if err_status == 0:
         # calc results
         print("Iter Master - processing results")
 
-        stack_aid = np.vstack(total_aid)
-        mean_aid = np.mean(stack_aid, axis=0)
-        std_aid = np.std(stack_aid, axis=0)
-        var_aid = np.var(stack_aid, axis=0)
+        iterations = iter_stats["n"]
 
-        sum_aid = np.sum(mean_aid)
+        if iter_tiles > 0:
+            (sum_aid, error_log_sum) = tile_sums
+            error_log_mean = error_log_sum / int(idx+1)
+            error_log_percent =  error_log_sum / sum_aid
 
-        stack_count = np.vstack(total_count)
-        mean_count = np.mean(stack_count, axis=0)
-        std_count = np.std(stack_count, axis=0)
-        var_aid = np.var(stack_aid, axis=0)
-
-
-        # error_log = 0
-
-        error_surf = np.absolute(np.subtract(sum_mean_surf, mean_aid))
+        else:
+            (mean_aid, std_aid, var_aid) = statsResult(iter_stats, "aid")
 
-        error_surf_str = ' '.join(np.char.mod('%f', error_surf))
-        asc_error_surf_str = asc + error_surf_str
+            sum_aid = np.sum(mean_aid)
 
-        fout_error_surf = open(dir_working+"/error_surf.asc", "w")
-        fout_error_surf.write(asc_error_surf_str)
+            (mean_count, std_count, var_count) = statsResult(iter_stats, "count")
 
-        error_log_mean = np.mean(np.absolute(error_surf))
-        error_log_sum = np.sum(np.absolute(error_surf))
-        error_log_percent =  error_log_sum / sum_aid
+            (mean_aid, std_aid, var_aid) = (cellFull(mean_aid), cellFull(std_aid), cellFull(var_aid))
+            (mean_count, std_count, var_count) = (cellFull(mean_count), cellFull(std_count), cellFull(var_count))
 
-        results_str += "\nerror mean\t" + str(error_log_mean)
-        results_str += "\nerror sum\t" + str(error_log_sum)
-        results_str += "\nerror percent\t" + str(error_log_percent)
+            # keep statistics so run can be extended or merged with other runs
+            # checkpoint is no longer needed once final statistics are saved
+            iterStateSave(statsPath(), iter_stats, run_seed, iter_checks)
+            if os.path.isfile(checkpointPath()):
+                os.remove(checkpointPath())
 
 
-        # write core asc output files
+            # error_log = 0
 
-        mean_aid_str = ' '.join(np.char.mod('%f', mean_aid))
-        asc_mean_aid_str = asc + mean_aid_str
-        fout_mean_aid = open(dir_working+"/mean_aid.asc", "w")
-        fout_mean_aid.write(asc_mean_aid_str)
+            error_surf = np.absolute(np.subtract(sum_mean_surf, mean_aid))
 
-        std_aid_str = ' '.join(np.char.mod('%f', std_aid))
-        asc_std_aid_str = asc + std_aid_str
-        fout_std_aid = open(dir_working+"/std_aid.asc", "w")
-        fout_std_aid.write(asc_std_aid_str)
+            error_surf_str = ' '.join(np.char.mod('%f', error_surf))
+            asc_error_surf_str = asc + error_surf_str
 
-        var_aid_str = ' '.join(np.char.mod('%f', var_aid))
-        asc_var_aid_str = asc + var_aid_str
-        fout_var_aid = open(dir_working+"/var_aid.asc", "w")
-        fout_var_aid.write(asc_var_aid_str)
+            fout_error_surf = open(dir_working+"/error_surf.asc", "w")
+            fout_error_surf.write(asc_error_surf_str)
+            fout_error_surf.close()
 
+            error_log_mean = np.mean(np.absolute(error_surf))
+            error_log_sum = np.sum(np.absolute(error_surf))
+            error_log_percent =  error_log_sum / sum_aid
 
-        mean_count_str = ' '.join(np.char.mod('%f', mean_count))
-        asc_mean_count_str = asc + mean_count_str
-        fout_mean_count = open(dir_working+"/mean_count.asc", "w")
-        fout_mean_count.write(asc_mean_count_str)
+        results_str += "\nresumed iterations\t" + str(iter_resumed)
+        results_str += "\nextended from iterations\t" + str(iter_extended_from)
+        results_str += "\nextended iterations\t" + str(iter_extend)
+        results_str += "\nrun seed\t" + str(run_seed)
+        results_str += "\ntask failures\t" + str(task_counts["failures"])
+        results_str += "\ntasks reassigned\t" + str(task_counts["reassigned"])
+        results_str += "\nworkers quarantined\t" + str(len(task_quarantine) + task_counts["quarantined"])
+        results_str += "\nworkers lost\t" + str(task_counts["lost"])
+        results_str += "\ntasks speculated\t" + str(task_counts["speculated"])
+        results_str += "\nspeculation wins\t" + str(task_counts["speculation_wins"])
+        results_str += "\nsurf task seconds (median, p95)\t" + str(taskSeconds(tags.SURF))
+        results_str += "\niter task seconds (median, p95)\t" + str(taskSeconds(tags.START))
+        results_str += "\nerror mean\t" + str(error_log_mean)
+        results_str += "\nerror sum\t" + str(error_log_sum)
+        results_str += "\nerror percent\t" + str(error_log_percent)
 
-        std_count_str = ' '.join(np.char.mod('%f', std_count))
-        asc_std_count_str = asc + std_count_str
-        fout_std_count = open(dir_working+"/std_count.asc", "w")
-        fout_std_count.write(asc_std_count_str)
 
-        var_count_str = ' '.join(np.char.mod('%f', var_count))
-        asc_var_count_str = asc + var_count_str
-        fout_var_count = open(dir_working+"/var_count.asc", "w")
-        fout_var_count.write(asc_var_count_str)
+        # write core asc output files
+        # (already joined from tile parts in tiled mode)
+        if iter_tiles == 0:
+
+            mean_aid_str = ' '.join(np.char.mod('%f', mean_aid))
+            asc_mean_aid_str = asc + mean_aid_str
+            fout_mean_aid = open(dir_working+"/mean_aid.asc", "w")
+            fout_mean_aid.write(asc_mean_aid_str)
+            fout_mean_aid.close()
+
+            std_aid_str = ' '.join(np.char.mod('%f', std_aid))
+            asc_std_aid_str = asc + std_aid_str
+            fout_std_aid = open(dir_working+"/std_aid.asc", "w")
+            fout_std_aid.write(asc_std_aid_str)
+            fout_std_aid.close()
+
+            var_aid_str = ' '.join(np.char.mod('%f', var_aid))
+            asc_var_aid_str = asc + var_aid_str
+            fout_var_aid = open(dir_working+"/var_aid.asc", "w")
+            fout_var_aid.write(asc_var_aid_str)
+            fout_var_aid.close()
+
+
+            mean_count_str = ' '.join(np.char.mod('%f', mean_count))
+            asc_mean_count_str = asc + mean_count_str
+            fout_mean_count = open(dir_working+"/mean_count.asc", "w")
+            fout_mean_count.write(asc_mean_count_str)
+            fout_mean_count.close()
+
+            std_count_str = ' '.join(np.char.mod('%f', std_count))
+            asc_std_count_str = asc + std_count_str
+            fout_std_count = open(dir_working+"/std_count.asc", "w")
+            fout_std_count.write(asc_std_count_str)
+            fout_std_count.close()
+
+            var_count_str = ' '.join(np.char.mod('%f', var_count))
+            asc_var_count_str = asc + var_count_str
+            fout_var_count = open(dir_working+"/var_count.asc", "w")
+            fout_var_count.write(asc_var_count_str)
+            fout_var_count.close()
 
 
         # calc section runtime and total runtime
         time_end = time.time()
-        T_iter = int(time_end - time_surf)
+        T_iter = int(time_end - time_iter)
         T_total = int(time_end - Ts)
 
+        # part of iteration phase mean surface tasks were also running
+        T_overlap = int(max(time_surf - time_iter, 0)) if surf_pipelined else 0
+
         # print final results
         print('\n\tRun Results:')
         print('\t\tError Value for ' + str(iterations) + ' iterations: ' + str(error_log_percent))
@@ -1085,10 +3707,12 @@ if rank == 0:
 
         # write to results.tsv
         results_str += "\nIterations Runtime\t" + str(T_iter//60) +'m '+ str(int(T_iter%60)) +'s'
+        results_str += "\nSurf Overlap Runtime\t" + str(T_overlap//60) +'m '+ str(int(T_overlap%60)) +'s'
         results_str += "\nTotal Runtime\t" + str(T_total//60) +'m '+ str(int(T_total%60)) +'s'
 
         fout_results = open(dir_working+"/results.tsv", "w")
         fout_results.write(results_str)
+        fout_results.close()
 
 
         # write to main log
@@ -1097,6 +3721,7 @@ if rank == 0:
         fout_array = [Rid, Ts, country, abbr, data_version, run_id, pixel_size, iter_max, iterations, error_log_percent, only_geocoded, size, run_mean_surf, T_init, T_surf, T_iter, T_total]
         fout_str = "\t".join(str(x) for x in fout_array)
         fout_log.write(fout_str + "\n")
+        fout_log.close()
 
 
     else:
@@ -1106,104 +3731,28 @@ if rank == 0:
     # ==================================================
 
 
-else:
-    # Worker processes execute code below
-    name = MPI.Get_processor_name()
-    print("Iter Worker - rank %d on %s." % (rank, name))
-    while True:
-        comm.send(None, dest=0, tag=tags.READY)
-        task = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
-        tag = status.Get_tag()
-
-        if tag == tags.START:
-
-            # ==================================================
-            # WORKER STUFF
-
-
-            # --------------------------------------------------
-            # generate random dollars
-
-            i_mx = deepcopy(i_m)
-
-            # add new column of random numbers (0-1)
-            i_mx['ran_num'] = (pd.Series(np.random.random(len(i_mx)))).values
-
-            # group merged table by project ID for the sum of each project ID's random numbers
-            grouped_random_series = i_mx.groupby('project_id')['ran_num'].sum()
-
-
-            # create new empty dataframe
-            df_group_random = pd.DataFrame()
-
-            # add grouped random 'Series' to the newly created 'Dataframe' under a new grouped_random column
-            df_group_random['grouped_random'] = grouped_random_series
-
-            # add the series index, composed of project IDs, as a new column called project_id
-            df_group_random['project_id'] = df_group_random.index
-
-
-            # now that we have project_id in both the original merged 'Dataframe' and the new 'Dataframe' they can be merged
-            i_mx = i_mx.merge(df_group_random, on='project_id')
-
-            # calculate the random dollar ammount per point for each entry
-            i_mx['random_dollars_pp'] = (i_mx.ran_num / i_mx.grouped_random) * i_mx[aid_field]
-
-
-            # --------------------------------------------------
-            # assign random points
-
-            # add random points column to table
-            i_mx["rnd_pt"] = [0] * len(i_mx)
-            i_mx.rnd_pt = i_mx.apply(lambda x: addPt(x.agg_type, x.agg_geom), axis=1)
+elif rank in tile_ranks:
+    tileLoop()
 
-            # drop rnd_x and rnd_y if they exist
-            if "rnd_x" in i_mx.columns or "rnd_y" in i_mx.columns:
-                i_mx.drop(['rnd_x','rnd_y'], inplace=True, axis=1)
+elif rank in iter_workers and group_size != 0:
+    groupLoop([r for r in [g for g in group_ranks if g[0] == rank][0][1:] if r not in iter_lost])
 
-            # round rnd_pts to match point grid
-            i_mx = i_mx.merge(i_mx.rnd_pt.apply(lambda s: pd.Series({'rnd_x':(round(s.x * psi) / psi), 'rnd_y':(round(s.y * psi) / psi)})), left_index=True, right_index=True)
+elif group_size != 0:
+    workerLoop("Iter", [g[0] for g in group_ranks if rank in g][0])
 
-
-            # --------------------------------------------------
-            # add results to output arrays
-
-            # initialize mean and count grids with zeros
-            npa_aid = np.zeros((int(idx+1),), dtype=np.int)
-            npa_count = np.zeros((int(idx+1),), dtype=np.int)
-
-            # add commitment value for each rnd pt to grid value
-            for i in i_mx.iterrows():
-                try:
-                    nx = str(i[1].rnd_x)
-                    ny = str(i[1].rnd_y)
-                    # print nx, ny, gref[nx][ny]
-                    if int(i[1].random_dollars_pp) > 0:
-                        npa_aid[gref[ny][nx]] += int(i[1].random_dollars_pp)
-                        npa_count[gref[ny][nx]] += int(1)
-
-                except:
-                    print("Iter Worker - error on worker %d with tasks %s." % (rank, task))
-
-
-            # --------------------------------------------------
-            # send np arrays back to master
-
-            npa_result = np.array([npa_aid,npa_count])
-            comm.send(npa_result, dest=0, tag=tags.DONE)
+else:
+    # Worker processes execute code below
+    workerLoop("Iter")
 
 
-            # ==================================================
+# shut down local pool (hybrid backend workers or local backend master)
+poolReset()
 
-        elif tag == tags.EXIT:
-            comm.send(None, dest=0, tag=tags.EXIT)
-            break
 
-        elif tag == tags.ERROR:
-            print("Iter Worker - error message from Iter Master. Shutting down." % source)
-            # confirm error message received and exit
-            comm.send(None, dest=0, tag=tags.EXIT)
-            break
+# run did not finish, other ranks may be lost or waiting on lost ranks
+if rank == 0 and err_status != 0:
+    print("Iter Master - aborting after worker error")
+    comm.Abort(1)
 
 
 # ====================================================================================================
@@ -1233,9 +3782,23 @@ if rank == 0:
     add_json("run_id",run_id)
 
     add_json("force_mean_surf",force_mean_surf)
+    add_json("surf_pipeline",surf_pipeline)
+    add_json("node_shared",node_shared)
+    add_json("compact_cells",compact_cells)
+    add_json("iter_tiles",iter_tiles)
+    add_json("group_size",group_size)
+    add_json("task_prefetch",task_prefetch)
+    add_json("task_timeout",task_timeout)
+    add_json("task_failures_max",task_failures_max)
+    add_json("task_speculate",task_speculate)
+    add_json("task_speculate_min",task_speculate_min)
+    add_json("backend",backend)
+    add_json("pool_size",pool_size)
+    add_json("pool_type",pool_type)
     add_json("iter_max",iter_max)
     add_json("iter_thresh",iter_thresh)
     add_json("iter_improvement",iter_improvement)
+    add_json("checkpoint_interval",checkpoint_interval)
     add_json("dir_working",dir_working)
     add_json("filters_type",filters_type)
     add_json("filters",filters)
@@ -1251,18 +3814,43 @@ if rank == 0:
     add_json("adm0_maxy",adm0_maxy)
     add_json("rows",len(rows))
     add_json("cols",len(cols))
+    add_json("grid_size",grid_size)
     add_json("locations",len(i_m))
     add_json("T_init",T_init)
     add_json("run_mean_surf",run_mean_surf)
+    add_json("surf_hash",surf_hash)
     # add_json("path of surf file used",)
     add_json("T_surf",T_surf)
     add_json("iterations",iterations)
+    add_json("iter_resumed",iter_resumed)
+    add_json("iter_extended_from",iter_extended_from)
+    add_json("iter_extend",iter_extend)
+    add_json("iter_sampling",iter_sampling)
+    add_json("iter_dtype",iter_dtype)
+    add_json("iter_group_min",iter_group_min)
+    add_json("run_seed",run_seed)
+    add_json("task_failures",task_counts["failures"])
+    add_json("task_reassigned",task_counts["reassigned"])
+    add_json("task_quarantined",len(task_quarantine) + task_counts["quarantined"])
+    add_json("task_lost",task_counts["lost"])
+    add_json("task_speculated",task_counts["speculated"])
+    add_json("task_speculation_wins",task_counts["speculation_wins"])
+    add_json("surf_task_seconds",taskSeconds(tags.SURF))
+    add_json("iter_task_seconds",taskSeconds(tags.START))
     add_json("error_log_mean",error_log_mean)
     add_json("error_log_sum",error_log_sum)
     add_json("error_log_percent",error_log_percent)
     add_json("T_iter",T_iter)
+    add_json("T_overlap",T_overlap)
     add_json("T_total",T_total)
 
     json_out = dir_base+'/json/mongo/ready/'+str(Rid)+'.json'
     json_handle = open(json_out, 'w')
     json.dump(mops, json_handle, sort_keys = True, indent = 4, ensure_ascii=False)
+    json_handle.close()
+
+    # lost workers can not take part in shutting down
+    # outputs are complete, lost workers are recorded in results and the run exits with an error
+    if task_counts["lost"] > 0:
+        print("Iter Master - aborting remaining ranks after lost workers")
+        comm.Abort(1)